@@ -0,0 +1,69 @@
+import numpy as np
+from scipy.stats import norm
+from cam_utils import SECTIONS
+
+
+class BaselineStatistics:
+    """Running per-square statistics of the idle SSIM differences.
+
+    For every channel (the whole square and each of its sections) and square it keeps
+    an exponentially weighted mean and variance, updated with West's incremental form
+    of Welford's algorithm. The first samples are weighted 1/n, so a fresh store holds
+    the plain mean and population variance, after that each sample weighs `decay`.
+    Thresholds are read from the arrays in O(1).
+    """
+
+    CHANNELS = ['overall'] + SECTIONS
+
+    def __init__(self, num_squares=64, decay=0.02, percentile=0.999):
+        self.decay = decay
+        self.z_score = norm.ppf(percentile)  # Constant, computed once
+
+        shape = (len(self.CHANNELS), num_squares)
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.var = np.zeros(shape)
+        # Median minus mean of the calibration samples, the median then follows the mean
+        self.median_offset = np.zeros(shape)
+
+    def reset(self, channel, diffs, squares=slice(None)):
+        """Replace the statistics of `squares` with those of `diffs` (samples, squares)."""
+        c = self.CHANNELS.index(channel)
+        diffs = np.asarray(diffs, dtype=np.float64)
+        self.count[c, squares] = diffs.shape[0]
+        self.mean[c, squares] = diffs.mean(axis=0)
+        self.var[c, squares] = diffs.var(axis=0)
+        self.median_offset[c, squares] = np.median(diffs, axis=0) - diffs.mean(axis=0)
+
+    def update(self, channel, diffs, squares=slice(None)):
+        """Add each row of `diffs` (samples, squares) as a new sample."""
+        c = self.CHANNELS.index(channel)
+        for row in np.atleast_2d(diffs):
+            self.count[c, squares] += 1
+            alpha = np.maximum(1 / self.count[c, squares], self.decay)
+            delta = row - self.mean[c, squares]
+            self.mean[c, squares] += alpha * delta
+            self.var[c, squares] = (1 - alpha) * (self.var[c, squares] + alpha * delta ** 2)
+
+    def update_idle(self, diffs):
+        """Add the differences (samples, channels, squares) of a frame where no move was found.
+
+        Only squares whose mean overall difference is within their estimated maximum are
+        added. One above it may hold a small real change (a piece half moved) that stayed
+        under large_threshold, and would push its thresholds up. Squares that were not
+        compared (NaN) have no sample.
+        """
+        idle = diffs[:, 0].mean(axis=0) <= self.estimated_max('overall')
+        for c, channel in enumerate(self.CHANNELS):
+            self.update(channel, diffs[:, c, idle], squares=idle)
+
+    def std(self, channel):
+        return np.sqrt(self.var[self.CHANNELS.index(channel)])
+
+    def median(self, channel):
+        c = self.CHANNELS.index(channel)
+        return self.mean[c] + self.median_offset[c]
+
+    def estimated_max(self, channel):
+        c = self.CHANNELS.index(channel)
+        return self.mean[c] + self.z_score * np.sqrt(self.var[c])
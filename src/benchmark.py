@@ -0,0 +1,249 @@
+import argparse
+import inspect
+import json
+import os
+import time
+from collections import defaultdict
+import chess
+import chess.pgn
+import numpy as np
+from camera import Camera
+from frame_source import ReplaySource, FrameSourceFinished, get_capture_profile
+
+# A session is a FrameRecorder folder (see frame_source.py) with the moves that were
+# actually played in game.pgn. Every move of the game is expected to be made by hand in
+# front of the camera, as in human-human games.
+
+PGN_FILE = 'game.pgn'
+PERCENTILES = [50, 90, 99]
+
+
+class BenchmarkResult:
+    """Counts and timings of one configuration over one or more sessions."""
+
+    def __init__(self, name):
+        self.name = name
+        self.moves = 0            # Moves in the ground truth
+        self.exact = 0            # Single move returned and it was the played one
+        self.ambiguous = 0        # List of candidates returned that contained the played move
+        self.false_positives = 0  # Distinct moves or candidate lists returned per ply that did not match
+        self.missed = 0           # Moves not detected before the recording ended
+        self.idle_calls = 0       # recognize_move calls that returned nothing
+        self.latencies = []       # Seconds spent in the recognize_move call that found the move
+        self.stage_times = defaultdict(list)
+
+    def merge(self, other):
+        for attr in ['moves', 'exact', 'ambiguous', 'false_positives', 'missed', 'idle_calls']:
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        self.latencies.extend(other.latencies)
+        for stage, times in other.stage_times.items():
+            self.stage_times[stage].extend(times)
+
+    def summary(self):
+        detections = self.exact + self.ambiguous + self.false_positives
+        summary = {
+            'moves': self.moves,
+            'accuracy': self.exact / self.moves if self.moves else 0,
+            'ambiguity_rate': self.ambiguous / self.moves if self.moves else 0,
+            'false_positive_rate': self.false_positives / detections if detections else 0,
+            'missed': self.missed,
+            'idle_calls': self.idle_calls,
+        }
+        for p in PERCENTILES:
+            summary[f'latency_p{p}_ms'] = float(np.percentile(self.latencies, p)) * 1000 if self.latencies else 0
+        for stage, times in sorted(self.stage_times.items()):
+            summary[f'{stage}_mean_ms'] = float(np.mean(times)) * 1000
+        return summary
+
+
+def timed(stage_times, stage, func):
+    """Wrap a bound method so every call adds its duration to stage_times[stage]."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_times[stage].append(time.perf_counter() - start)
+    return wrapper
+
+
+def create_camera(session_path, config):
+    """Camera on an unthrottled replay of the session, configured from `config`.
+
+    Keys that are Camera arguments are passed to the constructor, the others are set as
+    attributes afterwards. Dotted keys reach into members, e.g. "stability_detector.stable_frames".
+    "capture_profile" takes a CAPTURE_PROFILES name or a dict of CaptureProfile arguments.
+    """
+    arguments = inspect.signature(Camera.__init__).parameters
+    kwargs = {key: value for key, value in config.items() if key in arguments}
+    kwargs.setdefault('select_corners', False)
+    kwargs.setdefault('timing_interval', None)  # The benchmark reports its own timings
+
+    # The replay is resized to the resolution of the capture profile
+    kwargs['capture_profile'] = get_capture_profile(kwargs.get('capture_profile'))
+    source = ReplaySource(session_path, realtime=False, size=(kwargs['capture_profile'].width, kwargs['capture_profile'].height))
+
+    camera = Camera(frame_source=source, show_heatmaps=False, show_preview=False, **kwargs)
+
+    for key, value in config.items():
+        if key in arguments:
+            continue
+        target = camera
+        *path, attr = key.split('.')
+        for member in path:
+            target = getattr(target, member)
+        setattr(target, attr, value)
+
+    return camera
+
+
+def matches(detected, expected):
+    # Promotions are asked to the player, so only the squares have to match
+    return detected.from_square == expected.from_square and detected.to_square == expected.to_square
+
+
+def detection_found(detected, expected):
+    """Whether a recognize_move answer (move, candidate list or None) contains the expected move."""
+    if isinstance(detected, list):
+        return any(matches(move, expected) for move in detected)
+    return detected is not None and matches(detected, expected)
+
+
+def detection_key(detected):
+    """Hashable form of a recognize_move answer, so a misdetection repeated on every frame counts once."""
+    if isinstance(detected, list):
+        return frozenset(move.uci() for move in detected)
+    return detected.uci()
+
+
+def read_game(session_path):
+    with open(os.path.join(session_path, PGN_FILE)) as f:
+        return chess.pgn.read_game(f)
+
+
+def run_session(session_path, config, name='benchmark', observer=None):
+    """Replay one session, `observer(camera, board, detected, expected, found)` sees every call."""
+    game = read_game(session_path)
+    board = game.board()
+    expected_moves = list(game.mainline_moves())
+
+    result = BenchmarkResult(name)
+    result.moves = len(expected_moves)
+
+    camera = create_camera(session_path, config)
+    stages = {
+        'capture': 'get_processed_frame',
+        'square_ssim': 'ssim_square',
+        'section_ssim': 'ssim_small',
+        'compare': 'compare_squares',
+        'classify': 'classify_squares',
+        'reference_update': 'update_after_move',
+    }
+    for stage, method in stages.items():
+        setattr(camera, method, timed(result.stage_times, stage, getattr(camera, method)))
+
+    detected_count = 0
+    try:
+        for expected in expected_moves:
+            wrong_detections = set()  # Of this ply
+            while True:
+                start = time.perf_counter()
+                detected = camera.recognize_move(board)
+                elapsed = time.perf_counter() - start
+
+                found = detection_found(detected, expected)
+
+                if observer is not None:
+                    observer(camera, board, detected, expected, found)
+
+                if detected is None:
+                    result.idle_calls += 1
+                    continue
+
+                # Scoring is what recognize_move adds on top of the comparison
+                comparison = 'classify' if camera.square_classifier is not None else 'compare'
+                result.stage_times['scoring'].append(elapsed - result.stage_times[comparison][-1])
+
+                if found and isinstance(detected, list):
+                    result.ambiguous += 1
+                    break
+                elif found:
+                    result.exact += 1
+                    break
+
+                # In a game the player would now correct the move, here we keep watching.
+                # The same wrong answer on the following frames is one misdetection.
+                key = detection_key(detected)
+                if key not in wrong_detections:
+                    wrong_detections.add(key)
+                    result.false_positives += 1
+
+            result.latencies.append(elapsed)
+            detected_count += 1
+
+            board.push(expected)
+            camera.update_after_move(board)
+    except FrameSourceFinished:
+        pass
+    finally:
+        camera.close()
+
+    result.missed = len(expected_moves) - detected_count
+    return result
+
+
+def find_sessions(path):
+    if os.path.exists(os.path.join(path, PGN_FILE)):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if os.path.exists(os.path.join(path, name, PGN_FILE)))
+
+
+def run_benchmark(sessions, config, name='benchmark'):
+    total = BenchmarkResult(name)
+    for session_path in sessions:
+        print(f"[{name}] {session_path}")
+        total.merge(run_session(session_path, config, name))
+    return total
+
+
+def print_comparison(results):
+    summaries = [result.summary() for result in results]
+    keys = list(dict.fromkeys(key for summary in summaries for key in summary))
+
+    print("-"*20)
+    print(f"{'metric':<28}" + "".join(f"{result.name:>14}" for result in results))
+    for key in keys:
+        print(f"{key:<28}" + "".join(f"{summary.get(key, 0):>14.3f}" for summary in summaries))
+    print()
+
+
+def load_config(path):
+    if path is None:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded sessions through Camera.recognize_move")
+    parser.add_argument('sessions', help="Session folder, or a folder of session folders")
+    parser.add_argument('--config', default=None, help="JSON with Camera arguments and attributes")
+    parser.add_argument('--compare', default=None, help="Second configuration, reported next to the first one")
+    parser.add_argument('--output', default=None, help="Write the summaries to this JSON file")
+    args = parser.parse_args()
+
+    sessions = find_sessions(args.sessions)
+    results = [run_benchmark(sessions, load_config(args.config), name='baseline')]
+    if args.compare is not None:
+        results.append(run_benchmark(sessions, load_config(args.compare), name='candidate'))
+
+    print_comparison(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({result.name: result.summary() for result in results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
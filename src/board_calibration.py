@@ -0,0 +1,179 @@
+import json
+import os
+import cv2
+import numpy as np
+from cam_utils import detect_chessboard
+
+# Inner corners of the chessboard pattern in square units, in findChessboardCorners order
+GRID_SIZE = 7
+GRID_POINTS = np.array([(col + 1, row + 1) for row in range(GRID_SIZE) for col in range(GRID_SIZE)], dtype=np.float32)
+
+
+def grid_orderings():
+    # findChessboardCorners may start from any corner of a square pattern, so the same
+    # points can come in any of the 8 rotations and mirrors of the index grid
+    index = np.arange(GRID_SIZE * GRID_SIZE).reshape(GRID_SIZE, GRID_SIZE)
+    for k in range(4):
+        rotated = np.rot90(index, k)
+        yield rotated.reshape(-1)
+        yield rotated.T.reshape(-1)
+
+
+def transform_points(M, points):
+    return cv2.perspectiveTransform(np.asarray(points, dtype=np.float32).reshape(-1, 1, 2), M).reshape(-1, 2)
+
+
+class BoardCalibration:
+    """Board corners of the camera setup, saved to disk and checked for drift.
+
+    Small grayscale patches around the corner markers are stored with the corners.
+    check() finds them again in a new frame with template matching in a small search
+    window, which is cheap enough to run periodically. When the camera moved, the
+    corners follow the matched markers, or the chessboard pattern if it is visible (only
+    on an empty board). `board_points` are the corners in chessboard square units,
+    known once the pattern was seen, so the pattern alone gives the corners. Until then
+    (a first calibration) the markers are the only source of the corners.
+    """
+
+    def __init__(self, corners, patches, board_points=None, patch_size=32, search_radius=24,
+                 min_score=0.6, tolerance=2.0):
+        self.corners = [tuple(corner) for corner in corners]
+        self.patches = patches
+        self.board_points = board_points
+        self.patch_size = patch_size
+        self.search_radius = search_radius
+        self.min_score = min_score
+        self.tolerance = tolerance
+
+    @classmethod
+    def from_frame(cls, corners, color_image, **kwargs):
+        gray = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
+        calibration = cls(corners, None, **kwargs)
+        calibration.patches = [calibration._patch(gray, corner) for corner in corners]
+
+        # Locate the corners on the chessboard pattern when it can be seen
+        grid = find_grid_homography(color_image)
+        if grid is not None:
+            calibration.board_points = transform_points(np.linalg.inv(grid), corners)
+        return calibration
+
+    def _patch(self, gray, point, radius=0):
+        half = self.patch_size // 2 + radius
+        x, y = int(round(point[0])), int(round(point[1]))
+        height, width = gray.shape[:2]
+        if x - half < 0 or y - half < 0 or x + half > width or y + half > height:
+            return None
+        return gray[y - half:y + half, x - half:x + half].copy()
+
+    def check(self, gray):
+        """Offset of every marker patch in `gray` and its match score (NaN when not found)."""
+        offsets = np.full((len(self.corners), 2), np.nan)
+        scores = np.zeros(len(self.corners))
+        for i, (corner, patch) in enumerate(zip(self.corners, self.patches)):
+            window = self._patch(gray, corner, self.search_radius)
+            if patch is None or window is None:
+                continue
+            result = cv2.matchTemplate(window, patch, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (x, y) = cv2.minMaxLoc(result)
+            offsets[i] = (x - self.search_radius, y - self.search_radius)
+            scores[i] = score
+        return offsets, scores
+
+    def has_drifted(self, gray):
+        offsets, scores = self.check(gray)
+        seen = scores >= self.min_score
+        if seen.sum() < 3:
+            return True  # The markers are not where they were
+        return np.median(np.linalg.norm(offsets[seen], axis=1)) > self.tolerance
+
+    def recalibrate(self, color_image):
+        """New calibration for a moved camera, or None when the board cannot be found."""
+        gray = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
+        corners = self._follow_markers(gray)
+        if corners is None:
+            corners = self._from_grid(color_image)
+        if corners is None:
+            return None
+
+        calibration = BoardCalibration.from_frame(corners, color_image, patch_size=self.patch_size,
+                                                  search_radius=self.search_radius, min_score=self.min_score,
+                                                  tolerance=self.tolerance)
+        if calibration.board_points is None:
+            calibration.board_points = self.board_points
+        return calibration
+
+    def _follow_markers(self, gray):
+        # Move the corners with the markers that were found, a homography needs four
+        offsets, scores = self.check(gray)
+        seen = scores >= self.min_score
+        old = np.array(self.corners, dtype=np.float32)[seen]
+        new = old + offsets[seen].astype(np.float32)
+
+        if seen.all():
+            return [tuple(point) for point in np.round(new).astype(int).tolist()]
+        if seen.sum() >= 4:
+            M, _ = cv2.findHomography(old, new)
+        elif seen.sum() == 3:
+            A, _ = cv2.estimateAffine2D(old, new)
+            M = None if A is None else np.vstack([A, [0, 0, 1]])
+        else:
+            return None
+        if M is None:
+            return None
+        return [tuple(point) for point in np.round(transform_points(M, self.corners)).astype(int).tolist()]
+
+    def _from_grid(self, color_image):
+        if self.board_points is None:
+            return None
+        grid = find_grid_homography(color_image, self.board_points, self.corners)
+        if grid is None:
+            return None
+        return [tuple(point) for point in np.round(transform_points(grid, self.board_points)).astype(int).tolist()]
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez(os.path.splitext(path)[0] + '_patches.npz', *[patch if patch is not None else np.zeros(0) for patch in self.patches])
+        with open(path, 'w') as f:
+            json.dump({
+                'corners': [[int(x), int(y)] for x, y in self.corners],
+                'board_points': None if self.board_points is None else np.asarray(self.board_points).tolist(),
+                'patch_size': self.patch_size, 'search_radius': self.search_radius,
+                'min_score': self.min_score, 'tolerance': self.tolerance,
+            }, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        with np.load(os.path.splitext(path)[0] + '_patches.npz') as stored:
+            patches = [stored[f'arr_{i}'] for i in range(len(stored.files))]
+        patches = [patch if patch.size else None for patch in patches]
+        board_points = None if data['board_points'] is None else np.array(data['board_points'], dtype=np.float32)
+        return cls(data['corners'], patches, board_points, data['patch_size'], data['search_radius'],
+                   data['min_score'], data['tolerance'])
+
+
+def find_grid_homography(color_image, board_points=None, previous_corners=None):
+    """Homography from chessboard square units to the image, None without a visible pattern.
+
+    The pattern is symmetric, so with previous corners the orientation that maps
+    `board_points` closest to them is chosen.
+    """
+    found, grid = detect_chessboard(color_image.copy(), show=False)
+    if not found:
+        return None
+    grid = grid.reshape(-1, 2)
+
+    best, best_distance = None, np.inf
+    for order in grid_orderings():
+        M, _ = cv2.findHomography(GRID_POINTS, grid[order])
+        if M is None:
+            continue
+        if previous_corners is None:
+            return M
+        distance = np.linalg.norm(transform_points(M, board_points) - np.asarray(previous_corners, dtype=np.float32), axis=1).sum()
+        if distance < best_distance:
+            best, best_distance = M, distance
+    return best
@@ -3,6 +3,7 @@ import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 from scipy.stats import norm
+import chess
 
 
 def chess_square_to_camera_perspective(square_idx):
@@ -40,13 +41,13 @@ def select_points(image, num_points=6):
     
     return points
 
-def apply_perspective_transform(image, corners, chessboard_size=(7, 7), square_size_cm=4, pixels_per_cm=20):
-    if not (len(corners) == 4 or len(corners) == 6):
-        return None
-
-    # Main chessboard transform
+def board_homographies(corners, chessboard_size=(7, 7), square_size_cm=4, pixels_per_cm=20):
+    # Returns the output height and a list of (M, x_offset, width) parts, left to right,
+    # that together make up the warped board
     main_chessboard_width_px = (chessboard_size[0] - 1) * square_size_cm * pixels_per_cm
     chessboard_height_px = chessboard_size[1] * square_size_cm * pixels_per_cm
+
+    # Main chessboard transform
     pts_src_main = np.array([corners[0], corners[1], corners[2], corners[3]], dtype="float32")
     pts_dst_main = np.array([
         [0, 0],
@@ -55,23 +56,32 @@ def apply_perspective_transform(image, corners, chessboard_size=(7, 7), square_s
         [main_chessboard_width_px - 1, chessboard_height_px - 1],
     ], dtype="float32")
     M_main = cv2.getPerspectiveTransform(pts_src_main, pts_dst_main)
-    chessboard = cv2.warpPerspective(image, M_main, (main_chessboard_width_px, chessboard_height_px))
+
+    if len(corners) != 6:
+        return chessboard_height_px, [(M_main, 0, main_chessboard_width_px)]
 
     # Last column transform
-    if len(corners) == 6:
-        last_col_width_px = 7 * pixels_per_cm
-        pts_src_last_col = np.array([corners[4], corners[0], corners[5], corners[2]], dtype="float32")
-        pts_dst_last_col = np.array([
-            [0, 0],
-            [last_col_width_px - 1, 0],
-            [0, chessboard_height_px - 1],
-            [last_col_width_px - 1, chessboard_height_px - 1],
-        ], dtype="float32")
-        M_last_col = cv2.getPerspectiveTransform(pts_src_last_col, pts_dst_last_col)
-        last_column = cv2.warpPerspective(image, M_last_col, (last_col_width_px, chessboard_height_px))
-
-    # Combine the two parts
-        chessboard = np.hstack((last_column, chessboard)) # before rotation
+    last_col_width_px = 7 * pixels_per_cm
+    pts_src_last_col = np.array([corners[4], corners[0], corners[5], corners[2]], dtype="float32")
+    pts_dst_last_col = np.array([
+        [0, 0],
+        [last_col_width_px - 1, 0],
+        [0, chessboard_height_px - 1],
+        [last_col_width_px - 1, chessboard_height_px - 1],
+    ], dtype="float32")
+    M_last_col = cv2.getPerspectiveTransform(pts_src_last_col, pts_dst_last_col)
+
+    # The extended column goes before the main board (before rotation)
+    return chessboard_height_px, [(M_last_col, 0, last_col_width_px), (M_main, last_col_width_px, main_chessboard_width_px)]
+
+def apply_perspective_transform(image, corners, chessboard_size=(7, 7), square_size_cm=4, pixels_per_cm=20):
+    if not (len(corners) == 4 or len(corners) == 6):
+        return None
+
+    height, parts = board_homographies(corners, chessboard_size, square_size_cm, pixels_per_cm)
+
+    # Combine the parts
+    chessboard = np.hstack([cv2.warpPerspective(image, M, (width, height)) for M, _, width in parts])
 
     # Rotate the image around the y-axis (horizontal flip)
     #rotated_image = cv2.flip(combined_chessboard, 1)
@@ -79,6 +89,45 @@ def apply_perspective_transform(image, corners, chessboard_size=(7, 7), square_s
     cv2.imshow('Chessboard', chessboard)
     return chessboard
 
+class PerspectiveWarp:
+    """Precomputed version of apply_perspective_transform for fixed corners."""
+
+    def __init__(self, corners, image_shape, chessboard_size=(7, 7), square_size_cm=4, pixels_per_cm=20):
+        if not (len(corners) == 4 or len(corners) == 6):
+            raise ValueError(f"Expected 4 or 6 corners, got {len(corners)}")
+
+        height, parts = board_homographies(corners, chessboard_size, square_size_cm, pixels_per_cm)
+        width = sum(part_width for _, _, part_width in parts)
+
+        # Source coordinates of every output pixel, one homography per column range
+        map_x = np.empty((height, width), dtype=np.float32)
+        map_y = np.empty((height, width), dtype=np.float32)
+        ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+        for M, x_offset, part_width in parts:
+            cols = slice(x_offset, x_offset + part_width)
+            M_inv = np.linalg.inv(M)
+            px, py = xs[:, cols] - x_offset, ys[:, cols]
+            w = M_inv[2, 0] * px + M_inv[2, 1] * py + M_inv[2, 2]
+            map_x[:, cols] = (M_inv[0, 0] * px + M_inv[0, 1] * py + M_inv[0, 2]) / w
+            map_y[:, cols] = (M_inv[1, 0] * px + M_inv[1, 1] * py + M_inv[1, 2]) / w
+
+        # Only the bounding box of the board (plus one pixel for interpolation) is read
+        img_height, img_width = image_shape[:2]
+        self.x0 = int(np.clip(np.floor(map_x.min()) - 1, 0, img_width))
+        self.x1 = int(np.clip(np.ceil(map_x.max()) + 2, self.x0, img_width))
+        self.y0 = int(np.clip(np.floor(map_y.min()) - 1, 0, img_height))
+        self.y1 = int(np.clip(np.ceil(map_y.max()) + 2, self.y0, img_height))
+        map_x -= self.x0
+        map_y -= self.y0
+
+        # Fixed-point maps are what warpPerspective uses internally and remap faster
+        self.map1, self.map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        self.shape = (height, width)
+
+    def __call__(self, image, dst=None, interpolation=cv2.INTER_LINEAR):
+        roi = image[self.y0:self.y1, self.x0:self.x1]
+        return cv2.remap(roi, self.map1, self.map2, interpolation, dst=dst, borderMode=cv2.BORDER_CONSTANT)
+
 
 def divide_into_squares(warped_image, chessboard_size=(8, 8), extended_first_col_width_cm=7, pixels_per_cm=20, extended=True):
     squares = []
@@ -102,6 +151,83 @@ def divide_into_squares(warped_image, chessboard_size=(8, 8), extended_first_col
 
     return squares
 
+def square_boxes(shape, chessboard_size=(8, 8), extended_first_col_width_cm=7, pixels_per_cm=20, extended=True):
+    # Same geometry as divide_into_squares, but as (top, bottom, left, right) rows so
+    # that per-square reductions can be vectorized over the whole warped board
+    height, width = shape[:2]
+    square_height = int(height / chessboard_size[0])
+    square_width = int(width / chessboard_size[1]) if not extended else int((width - extended_first_col_width_cm * pixels_per_cm) / (chessboard_size[1] - 1))
+    extended_first_col_width_px = extended_first_col_width_cm * pixels_per_cm
+
+    boxes = []
+    for row in range(chessboard_size[0]):
+        for col in range(chessboard_size[1]):
+            if extended and col == 0:
+                col_width = extended_first_col_width_px
+            else:
+                col_width = square_width
+
+            start_col = col * square_width if not extended or col == 0 else extended_first_col_width_px + (col - 1) * square_width
+            # Clip like numpy slicing does in divide_into_squares
+            boxes.append((row * square_height, min((row + 1) * square_height, height), min(start_col, width), min(start_col + col_width, width)))
+
+    return np.array(boxes, dtype=np.int64)
+
+SECTIONS = ['center', 'left', 'right', 'top', 'bottom']
+
+def section_boxes(boxes):
+    # Boxes of the sections returned by split_into_sections, for every square box
+    top, bottom, left, right = boxes.T
+    h, w = bottom - top, right - left
+    return {
+        'center': np.stack([top + h // 4, top + 3 * h // 4, left + w // 4, left + 3 * w // 4], axis=1),
+        'left': np.stack([top, bottom, left, left + w // 2], axis=1),
+        'right': np.stack([top, bottom, left + w // 2, right], axis=1),
+        'top': np.stack([top, top + h // 2, left, right], axis=1),
+        'bottom': np.stack([top + h // 2, bottom, left, right], axis=1),
+    }
+
+def channel_boxes(boxes):
+    # Square boxes followed by the boxes of each section, shape (1 + len(SECTIONS), N, 4)
+    sections = section_boxes(boxes)
+    return np.stack([boxes] + [sections[section] for section in SECTIONS])
+
+def ssim_map(im1, im2, win_size=7, data_range=255, K1=0.01, K2=0.03):
+    # Local SSIM map with the same definition skimage's structural_similarity uses
+    # (uniform window, sample covariance). Every pixel further than win_size // 2 from
+    # a tile border only sees pixels of that tile, so pooling this map per tile gives
+    # the same score as calling structural_similarity on the tile itself.
+    im1 = im1.astype(np.float64)
+    im2 = im2.astype(np.float64)
+    ksize = (win_size, win_size)
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)
+
+    ux = cv2.blur(im1, ksize)
+    uy = cv2.blur(im2, ksize)
+    uxx = cv2.blur(im1 * im1, ksize)
+    uyy = cv2.blur(im2 * im2, ksize)
+    uxy = cv2.blur(im1 * im2, ksize)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    C1 = (K1 * data_range) ** 2
+    C2 = (K2 * data_range) ** 2
+    A1, A2 = 2 * ux * uy + C1, 2 * vxy + C2
+    B1, B2 = ux ** 2 + uy ** 2 + C1, vx + vy + C2
+    return (A1 * A2) / (B1 * B2)
+
+def pool_ssim_map(S, boxes, win_size=7):
+    # Mean of the SSIM map inside each box, ignoring the filter radius strip around the
+    # box edges (as skimage does per image). Uses a summed-area table, so the cost does
+    # not depend on the number of boxes. `boxes` can have any leading shape.
+    pad = (win_size - 1) // 2
+    integral = cv2.integral(S, sdepth=cv2.CV_64F)
+    top, bottom = boxes[..., 0] + pad, boxes[..., 1] - pad
+    left, right = boxes[..., 2] + pad, boxes[..., 3] - pad
+    sums = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+    return sums / ((bottom - top) * (right - left))
+
 def divide_into_squares_left(warped_image, chessboard_size=(8, 8), extended_last_col_width_cm=7, pixels_per_cm=20):
     squares = []
     square_size = int(warped_image.shape[0] / chessboard_size[0])
@@ -129,7 +255,9 @@ def detect_markers(image, select=False):
     if select:
         selected_points = select_points(image.copy())
     else:
-        selected_points = [(1066, 495), (1075, 865), (690, 495), (631, 865)]
+        # Measured on 1920x1080 frames, scaled to the resolution of the capture profile
+        scale = image.shape[1] / 1920
+        selected_points = [(int(round(x * scale)), int(round(y * scale))) for x, y in [(1066, 495), (1075, 865), (690, 495), (631, 865)]]
 
     # Convert image to float and apply SLIC
     #image_float = img_as_float(image)
@@ -166,7 +294,7 @@ def detect_markers(image, select=False):
     print(marker_corners)
     return marker_corners
 
-def detect_chessboard(cropped_image):
+def detect_chessboard(cropped_image, show=True):
     # Convert to HSV and create a mask to filter out green hues
     hsv = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2HSV)
     lower_green = np.array([60, 60, 40])  # Adjust these values
@@ -191,15 +319,81 @@ def detect_chessboard(cropped_image):
     closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
 
     # Find the chessboard corners
-    ret, corners = cv2.findChessboardCorners(closing, (7, 7), cv2.CALIB_CB_ADAPTIVE_THRESH)
+    ret, corners = cv2.findChessboardCorners(closing, (7, 7), cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK)
 
-    if ret:
-        # Draw corners on the cropped image
-        cv2.drawChessboardCorners(cropped_image, (7, 7), corners, ret)
+    if show:
+        if ret:
+            # Draw corners on the cropped image
+            cv2.drawChessboardCorners(cropped_image, (7, 7), corners, ret)
 
-    cv2.imshow('Processed Image', closing)
+        cv2.imshow('Processed Image', closing)
     return ret, corners if ret else None
 
+# Camera index <-> chess square tables (the mapping is its own inverse)
+CAMERA_TO_SQUARE = [chess_square_to_camera_perspective(idx) for idx in range(64)]
+SQUARE_TO_CAMERA = [chess_square_to_camera_perspective(square) for square in chess.SQUARES]
+
+class LegalMoveIndex:
+    """Legal moves of one position, keyed by (from, to) camera square indices.
+
+    Promotions keep every variant with the queen first. Castling is also reachable
+    through the (king from, rook from) pair, as both squares change on the board.
+    """
+
+    PROMOTION_ORDER = [chess.QUEEN, chess.KNIGHT, chess.ROOK, chess.BISHOP]
+
+    def __init__(self, board):
+        self.fen = board.fen()
+        self.moves = {}
+        self.castling_moves = set()
+
+        for move in board.legal_moves:
+            key = (SQUARE_TO_CAMERA[move.from_square], SQUARE_TO_CAMERA[move.to_square])
+            self.moves.setdefault(key, []).append(move)
+
+            if board.is_castling(move):
+                self.castling_moves.add(move)
+                rook_square = move_squares(board, move)[2]
+                self.moves.setdefault((key[0], SQUARE_TO_CAMERA[rook_square]), []).append(move)
+
+        for moves in self.moves.values():
+            if len(moves) > 1:
+                moves.sort(key=lambda move: self.PROMOTION_ORDER.index(move.promotion) if move.promotion else -1)
+
+        # Camera squares that can change this turn
+        self.relevant_squares = {idx for key in self.moves for idx in key}
+
+        # One move per square pair (preferred variant) with the camera squares it changes:
+        # from, to, and the rook or captured pawn squares for castling and en passant
+        self.move_list = list(dict.fromkeys(moves[0] for moves in self.moves.values()))
+        self.signatures = np.zeros((len(self.move_list), 64))
+        self.from_idx = np.zeros(len(self.move_list), dtype=np.int64)
+        self.to_idx = np.zeros((len(self.move_list), 2), dtype=np.int64)  # Either square counts as the destination
+        for i, move in enumerate(self.move_list):
+            changed = [SQUARE_TO_CAMERA[square] for square in move_squares(board, move)]
+            self.signatures[i, changed] = 1
+            self.from_idx[i] = changed[0]
+            self.to_idx[i] = [changed[1], changed[2] if move in self.castling_moves else changed[1]]
+
+    def get(self, from_idx, to_idx):
+        """Legal moves for the camera square pair, preferred variant first."""
+        return self.moves.get((from_idx, to_idx), [])
+
+    def __contains__(self, move):
+        return move in self.moves.get((SQUARE_TO_CAMERA[move.from_square], SQUARE_TO_CAMERA[move.to_square]), [])
+
+def move_squares(board, move):
+    # Chess squares whose content changes when `move` is played on `board`
+    squares = [move.from_square, move.to_square]
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        kingside = chess.square_file(move.to_square) > chess.square_file(move.from_square)
+        squares.append(chess.square(7 if kingside else 0, rank))  # Rook from
+        squares.append(chess.square(5 if kingside else 3, rank))  # Rook to
+    elif board.is_en_passant(move):
+        squares.append(chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)))
+    return squares
+
 def index_to_algebraic(square_index, board_size=8):
     file_letters = 'abcdefgh'
     rank = board_size - (square_index // board_size)
@@ -234,10 +428,10 @@ def calculate_estimated_maximum(mean, std, percentile=0.999):
     estimated_max = mean + z_score * std
     return estimated_max
 
-def calculate_threshold_metrics(diffs):
+def calculate_threshold_metrics(diffs, axis=None):
     return {
-        'median': np.median(diffs),
-        'max': np.max(diffs),
-        'std': np.std(diffs),
-        'estimated_max': calculate_estimated_maximum(np.mean(diffs), np.std(diffs))
-    }
\ No newline at end of file
+        'median': np.median(diffs, axis=axis),
+        'max': np.max(diffs, axis=axis),
+        'std': np.std(diffs, axis=axis),
+        'estimated_max': calculate_estimated_maximum(np.mean(diffs, axis=axis), np.std(diffs, axis=axis))
+    }
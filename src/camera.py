@@ -1,48 +1,110 @@
-import pyrealsense2 as rs
 import numpy as np
-import mediapipe as mp
-from mediapipe.tasks import python as mp_python
-from mediapipe.tasks.python import vision as mp_vision
-from mediapipe.tasks.python.components import containers
 from skimage.metrics import structural_similarity as ssim
 import matplotlib
-matplotlib.use("TkAgg")
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.gridspec as gridspec
+matplotlib.use("Agg")  # Only used to save diagnostics, the live heatmaps are drawn by HeatmapView
 import matplotlib.pyplot as plt
 from cam_utils import *
+from frame_grabber import FrameGrabber
+from frame_source import RealSenseSource, FrameSourceFinished, get_capture_profile
+from hand_detector import HandOcclusionService, MotionGate
+from stability_detector import StabilityDetector
+from baseline_statistics import BaselineStatistics
+from move_scorer import rank_moves, rank_moves_by_evidence, with_margins, select_changed_squares, select_detailed_squares, pick_move
+from square_classifier import SquareChangeClassifier
+from piece_identity import PieceIdentifier
+from depth_occupancy import DepthOccupancy, board_occupancy
+from board_calibration import BoardCalibration
+from ssim_kernel import SSIMKernel
+from stage_timer import StageTimer
+from heatmap_view import HeatmapView
+from frame_history import FrameHistory, WrongMoveArchiver
+from misdetection_archive import MisdetectionArchive, MAX_CANDIDATES
 import chess
+import queue
 import time
 import cv2
 import os
-import tkinter as tk
 import copy
 
 class Camera:
-    def __init__(self, select_corners, large_threshold=20, small_threshold=10, max_history=2, parent=None):
-        self._setup_camera()
+    def __init__(self, select_corners, large_threshold=20, small_threshold=10, max_history=2, parent=None, batched_ssim=True, baseline_decay=0.02, show_heatmaps=True, frame_source=None, show_preview=True, capture_profile=None, classifier_path=None, piece_store=None, use_depth=False, calibration_path=None, timing_log=None, timing_interval=60.0):
+        # Window with the warped frame, off for headless runs such as benchmarks
+        self.show_preview = show_preview
+
+        # Durations of the loop stages, dumped every timing_interval seconds (to timing_log
+        # as JSON lines, printed without one)
+        self.stage_timer = StageTimer(dump_interval=timing_interval, dump_path=timing_log)
+
+        # Stream settings, board ROI and warp resolution
+        self.capture_profile = get_capture_profile(capture_profile)
+        self.pixels_per_cm = self.capture_profile.pixels_per_cm
+
+        # Aligned depth, used to check the candidates against the occupied squares
+        self.use_depth = use_depth
+        self.depth_frame = None
+        self.depth_occupancy = None
+
+        # Corners are saved here and reused at startup while the camera has not moved
+        self.calibration_path = calibration_path
+        self.drift_check_interval = 10.0  # Seconds of frame time between drift checks
+        self.last_drift_check = 0
+        self.color_image = None
+
+        # Reference updates asked for from other threads, run by the next recognize_move:
+        # None to sample the whole board, or the board after a move for update_after_move
+        self.reference_requests = queue.Queue()
+
+        self._setup_camera(frame_source)
         self._get_corners(select_corners)
         self._init_hand_detector()
 
         self.large_threshold = large_threshold
         self.small_threshold = small_threshold
 
+        # Consecutive stable frames needed before the board counts as settled
         self.stability_threshold = 5
-        self.stable_frame_count = 0
-        self.last_stable_frame = None
-        self.stability_ssim_threshold = 0.97
+        self.stability_detector = StabilityDetector(stable_frames=self.stability_threshold)
+
+        # Compute one SSIM map per reference frame and pool it per square, instead of
+        # one structural_similarity call per square and reference sample
+        self.batched_ssim = batched_ssim
+        # float32 SSIM with reused buffers, one for whole frames and one for single tiles
+        self.ssim_kernel = SSIMKernel()
+        self.tile_ssim_kernel = SSIMKernel()
+
+        # Plotting of the calibration tiles, off by default as it is slow
+        self.save_diagnostics = False
+
+        # Legal moves by camera square pair, rebuilt when the position changes
+        self.move_index = None
+        # Score lead the best move needs to be returned on its own
+        self.move_margin = 50
+        # Largest changed squares whose sections are inspected
+        self.detailed_threshold = 6
+
+        # Optional learned replacement for the SSIM thresholds and section heuristics
+        self.square_classifier = SquareChangeClassifier(classifier_path) if classifier_path else None
+        # Chosen on held-out frames when the model was trained
+        self.classifier_threshold = self.square_classifier.threshold if self.square_classifier is not None else 0.5
+
+        # Optional piece recognition, used to prune ambiguous candidates
+        self.piece_identifier = PieceIdentifier(piece_store) if piece_store else None
+
+        # Per-square thresholds, seeded by each calibration and updated by idle frames
+        self.baseline_stats = BaselineStatistics(decay=baseline_decay)
 
         self.sample_board()
 
-        self.frame_history = []
         self.max_history = max_history
+        self.frame_history = FrameHistory(max_history)
         self.wrong_moves_folder = "wrong_moves"
+        self.archiver = WrongMoveArchiver(MisdetectionArchive(os.path.join(self.wrong_moves_folder, "archive")))
         self.correct_moves = 0
         self.wrong_moves = 0
 
         # Parent Tkinter widget
         self.parent = parent
-        self._init_heatmaps()  # Initialize heatmaps
+        self._init_heatmaps(show_heatmaps)  # Initialize heatmaps
 
         self.is_active = True
 
@@ -51,235 +113,235 @@ class Camera:
     # CAMERA SETUP   #
     ##################
 
-    def _setup_camera(self):
-        # Connect camera
-        self.pipe = rs.pipeline()
-        cfg = rs.config()
-        cfg.disable_all_streams()
-        cfg.enable_stream(rs.stream.color, 1920, 1080, rs.format.bgr8, 30)
-        self.pipe.start(cfg)
+    def _setup_camera(self, frame_source):
+        # Live RealSense by default, or a recorder/replay of a session
+        self.frame_source = frame_source if frame_source is not None else RealSenseSource.from_profile(self.capture_profile, depth=self.use_depth)
+        if self.use_depth and self.frame_source.depth_shape is None:
+            raise ValueError("use_depth needs a frame source with a depth stream")
+        self.frame_source.start()
 
-        # Lose the first 10 frames, as they are often darker
-        for _ in range(10):
-            _ = self.pipe.wait_for_frames()
+        # From now on a background thread keeps only the newest frames
+        self.grabber = FrameGrabber(self.frame_source)
+        self.grabber.start()
+        self.last_frame_time = 0
 
     def _get_corners(self, select_corners):
         # Get the corners of the markers
-        frame = self.pipe.wait_for_frames()
-        color_frame = frame.get_color_frame()
-        color_image = np.asanyarray(color_frame.get_data())
+        color_image = None
+        while color_image is None:
+            color_image, _ = self.grabber.latest()
+            if color_image is None and self.grabber.exhausted:
+                raise FrameSourceFinished()
+
+        if self.frame_source.corners is not None:
+            self.calibration = BoardCalibration.from_frame(self.frame_source.corners, color_image)
+        else:
+            self.calibration = self._load_calibration(color_image)
+            if self.calibration is None:
+                # Without a saved calibration the chessboard pattern cannot give the corners:
+                # it is symmetric, so nothing tells its orientation, and where the markers sit
+                # on it (board_points) is only known once they were located on a calibrated
+                # frame. A first start, or a moved camera whose markers and pattern are both
+                # lost, always goes through detect_markers.
+                self.calibration = BoardCalibration.from_frame(detect_markers(color_image, select_corners), color_image)
+                self._save_calibration()
+
+        self.frame_source.save_corners(self.calibration.corners)
+        self._apply_calibration(color_image.shape)
+
+    def _load_calibration(self, color_image):
+        # The saved corners are used as they are if the markers did not move, and
+        # followed to their new place if they did
+        if self.calibration_path is None or not os.path.exists(self.calibration_path):
+            return None
+
+        calibration = BoardCalibration.load(self.calibration_path)
+        if not calibration.has_drifted(cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)):
+            print("Using the saved calibration")
+            return calibration
 
-        self.corners = detect_markers(color_image, select_corners)
+        print("Camera moved since the last calibration")
+        calibration = calibration.recalibrate(color_image)
+        if calibration is not None:
+            self.calibration = calibration
+            self._save_calibration()
+        return calibration
+
+    def _save_calibration(self):
+        if self.calibration_path is not None:
+            self.calibration.save(self.calibration_path)
+
+    def _apply_calibration(self, image_shape):
+        self.corners = self.calibration.corners
         self.extended = len(self.corners) == 6
 
+        # The corners only change on recalibration, so the warp and the ROI are computed once
+        self.warp = PerspectiveWarp(self.corners, image_shape, pixels_per_cm=self.pixels_per_cm)
+        self.board_roi = self.capture_profile.board_roi(self.corners, image_shape)
+        self.depth_occupancy = None  # Refitted with the next references
+
+    def check_drift(self):
+        """Periodic check of the corners on the last accepted frame, True if they were redone."""
+        if self.color_image is None or self.last_frame_time - self.last_drift_check < self.drift_check_interval:
+            return False
+        self.last_drift_check = self.last_frame_time
+
+        if not self.calibration.has_drifted(cv2.cvtColor(self.color_image, cv2.COLOR_BGR2GRAY)):
+            return False
+
+        calibration = self.calibration.recalibrate(self.color_image)
+        if calibration is None:
+            print("Camera moved but the board was not found, keeping the calibration")
+            return False
+
+        print("Camera moved, recalibrating")
+        self.calibration = calibration
+        self._save_calibration()
+        self._apply_calibration(self.color_image.shape)
+        return True
+
     ##################
     # HEATMAP        #
     ##################
 
-    def _init_heatmaps(self):
-        # Create a Toplevel window for the combined heatmaps
-        self.heatmap_window = tk.Toplevel(self.parent)
-        self.heatmap_window.title("Heatmaps")
-
-        # Create a GridSpec with 4 columns and 2 rows (extra column for colorbar)
-        gs = gridspec.GridSpec(2, 4, width_ratios=[1, 1, 1, 0.05])
-        self.fig_heatmaps = plt.figure(figsize=(10, 6))
-
-        # Initialize the main heatmap and other detailed heatmaps
-        self.detailed_heatmaps = {}
-        heatmap_positions = {
-            'main': (0, 0), 'center': (0, 1), 'top': (0, 2),
-            'left': (1, 0), 'right': (1, 1), 'bottom': (1, 2)
-        }
-
-        # Create each heatmap
-        for section, pos in heatmap_positions.items():
-            ax = plt.subplot(gs[pos])
-            if section == 'main':
-                self.heatmap = ax.imshow([[0]*8 for _ in range(8)], interpolation='nearest', vmin=0, vmax=100, cmap='jet')
-                ax.set_title("Main Heatmap")
-            else:
-                # Initialize and store each detailed heatmap
-                detailed_heatmap = ax.imshow([[0]*8 for _ in range(8)], interpolation='nearest', vmin=0, vmax=100, cmap='jet')
-                self.detailed_heatmaps[section] = detailed_heatmap
-                ax.set_title(section.capitalize())
-            
-            ax.set_xticks(range(8))
-            ax.set_yticks(range(8))
-            ax.set_xticklabels(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'])
-            ax.set_yticklabels(['8', '7', '6', '5', '4', '3', '2', '1'])
-
-        # Create colorbar in the last column, spanning all rows
-        cb_ax = plt.subplot(gs[:, -1])
-        plt.colorbar(self.heatmap, cax=cb_ax)
-
-        # Adjust layout
-        plt.tight_layout()
+    def _init_heatmaps(self, show_heatmaps):
+        # Latest heatmap data, also stored in the history for the wrong move archive
+        self.heatmap_data = np.zeros((8, 8))
+        self.detailed_heatmap_data = {section: np.zeros((8, 8)) for section in SECTIONS}
 
-        # Embed the Matplotlib figure in the Tkinter window
-        self.canvas_heatmaps = FigureCanvasTkAgg(self.fig_heatmaps, master=self.heatmap_window)
-        self.canvas_heatmaps_widget = self.canvas_heatmaps.get_tk_widget()
-        self.canvas_heatmaps_widget.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+        # Rendered on the Tk thread at a capped rate, skipped entirely when headless
+        self.heatmap_view = HeatmapView(self.parent) if show_heatmaps else None
 
     def _update_heatmap(self, square_diffs, avg_diff, show_heatmap=False):
-        # Create a 2D array for the heatmap
-        heatmap_data = [[0] * 8 for _ in range(8)]
+        # Create a 2D array for the heatmap, a new one as the history may hold the old one
+        heatmap_data = np.zeros((8, 8))
         for idx, avg_diff in square_diffs:
             row, col = divmod(idx, 8)
-            heatmap_data[row][col] = avg_diff
-
-        # Update the heatmap data
-        self.heatmap.set_data(heatmap_data)
-        #self.fig.canvas.draw_idle()
-
-        # Bring the plot to the foreground only if required
-        #if show_heatmap:
-        #    plt.pause(0.001)  # Update the plot and bring it to the foreground
-        #else:
-        #    self.fig.canvas.start_event_loop(0.001)  # Update without bringing to foreground
-        
+            heatmap_data[row, col] = avg_diff
+
+        self.heatmap_data = heatmap_data
+
     def _update_detailed_heatmap(self, detailed_square_diffs):
         # Update heatmap values
-        heatmap_values = {section: [[0]*8 for _ in range(8)] for section in ['center', 'left', 'right', 'top', 'bottom']}
+        heatmap_values = {section: np.zeros((8, 8)) for section in SECTIONS}
         for idx, _, section_diffs in detailed_square_diffs:
             row, col = divmod(idx, 8)
             for section, value in section_diffs.items():
-                heatmap_values[section][row][col] = value
-
-        self.canvas_heatmaps.draw_idle()
-
-        self.detailed_heatmap_data = {}
-        # Update each heatmap and redraw
-        for section, data in heatmap_values.items():
-            self.detailed_heatmaps[section].set_data(data)
-            self.detailed_heatmap_data[section] = data
-
-    def _init_heatmap(self):
-        self.fig, self.ax = plt.subplots()
-        # Initialize with a fixed color scale range if known, e.g., vmin=0, vmax=1000
-        self.heatmap = self.ax.imshow([[0]*8 for _ in range(8)], interpolation='nearest', vmin=0, vmax=50, cmap='jet')
-        plt.colorbar(self.heatmap)
-
-        # Set the x-tick labels
-        self.ax.set_xticks(range(8))
-        self.ax.set_xticklabels(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'])
-
-        # Set the y-tick labels
-        self.ax.set_yticks(range(8))
-        self.ax.set_yticklabels(['8', '7', '6', '5', '4', '3', '2', '1'])
-
-        #plt.show(block=False)  # Show non-blocking plot
-
-    def _init_detailed_heatmap(self):
-        # Create a Toplevel window for the detailed heatmap
-        self.detailed_heatmap_window = tk.Toplevel(self.parent)
-        self.detailed_heatmap_window.title("Detailed Heatmap")
-
-        # Create a GridSpec with 5 columns and 1 row
-        gs = gridspec.GridSpec(1, 6, width_ratios=[1, 1, 1, 1, 1, 0.05])
-        self.fig_detailed = plt.figure(figsize=(15, 10))
-        self.detailed_heatmaps = {}
-
-        # Initialize heatmaps for each section
-        sections = ['center', 'left', 'right', 'top', 'bottom']
-        for i, section in enumerate(sections):
-            ax = plt.subplot(gs[i])
-            self.detailed_heatmaps[section] = ax.imshow([[0]*8 for _ in range(8)], interpolation='nearest', vmin=0, vmax=50, cmap='jet')
-            ax.set_title(section.capitalize())
-            ax.set_xticks(range(8))
-            ax.set_yticks(range(8))
-
-        # Create a single colorbar for all subplots
-        cb_ax = plt.subplot(gs[-1])
-        plt.colorbar(self.detailed_heatmaps[sections[0]], cax=cb_ax)
-
-        plt.tight_layout()
-
-        # Embed the Matplotlib figure in the Tkinter window
-        self.canvas_detailed = FigureCanvasTkAgg(self.fig_detailed, master=self.detailed_heatmap_window)
-        self.canvas_detailed_widget = self.canvas_detailed.get_tk_widget()
-        self.canvas_detailed_widget.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+                heatmap_values[section][row, col] = value
 
+        self.detailed_heatmap_data = heatmap_values
 
+        # Only hands over a snapshot, the view draws it when it gets to it
+        if self.heatmap_view is not None:
+            self.heatmap_view.publish(self.heatmap_data, self.detailed_heatmap_data)
 
     ############################
     # MEDIAPIPE / DETECT HANDS #
     ############################
 
     def _init_hand_detector(self):
-        base_options = mp_python.BaseOptions(model_asset_path=os.path.join('third_party', 'mediapipe', 'hand_landmarker.task'))
-        options = mp_vision.HandLandmarkerOptions(base_options=base_options, num_hands=1)
-        self.hand_detector = mp_vision.HandLandmarker.create_from_options(options)
-
-    def detect_hands(self, color_image):
-        cv2.imwrite(f'detect_hand.png', color_image)
-        #cv2.imshow(f'detect_hand.png', color_image)
-        
-        mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=color_image)
-        #mp_image = mp.Image.create_from_file(f'detect_hand.png')
-        
-        # Detect hands
-        detection_result = self.hand_detector.detect(mp_image)
-
-        # Check if hands are detected
-        if detection_result and detection_result.hand_landmarks:
-            print('Hands Detected!')
-            return len(detection_result.hand_landmarks) > 0
-        return False
+        # Runs asynchronously in LIVE_STREAM mode on a downscaled copy of the crop, and
+        # synchronously for lossless sources so that replays do not drop frames
+        self.hand_service = HandOcclusionService(synchronous=self.frame_source.lossless)
+        self.motion_gate = MotionGate()
+
+    def detect_hands(self, color_image, timestamp):
+        # Queue the frame for the hand model and report whether a hand was recently seen.
+        # The answer for this very frame may arrive later, see get_processed_frame.
+        # The model only runs when something moved, or to keep tracking a resting hand.
+        if self.motion_gate.check(color_image, timestamp) or self.hand_service.is_occluded(timestamp):
+            self.hand_service.submit(color_image, timestamp)
+        else:
+            self.hand_service.skip(timestamp)
+        return self.hand_service.is_occluded(timestamp)
     
     ##################
     # BOARD SAMPLING #
     ##################
 
-    def get_processed_frame(self, use_larger_context=True, crop_left = 500, crop_right=600, crop_bottom=100, crop_top=400):
+    def get_processed_frame(self, use_larger_context=True):
         while True:
-            frames = self.pipe.wait_for_frames()
-            color_frame = frames.get_color_frame()
-
-            if not color_frame:
+            # Newest frame not processed yet, older ones are dropped
+            with self.stage_timer.measure('capture_wait'):
+                grabbed = self.grabber.latest(after=self.last_frame_time, depth=self.use_depth)
+            color_image, timestamp = grabbed[:2]
+
+            if color_image is None:
+                if self.grabber.exhausted:
+                    raise FrameSourceFinished()
                 continue
 
-            color_image = np.asanyarray(color_frame.get_data())
-
-            height, width = color_image.shape[:2]
-
-            cropped_image = color_image[crop_top:(height - crop_bottom), crop_left:(width - crop_right)]
-            cropped_image = cropped_image.astype(np.uint8)
+            self.last_frame_time = timestamp
 
-            warped_image = apply_perspective_transform(color_image, self.corners)
+            # Hands and stability are only checked around the board
+            top, bottom, left, right = self.board_roi
+            cropped_image = color_image[top:bottom, left:right]
 
-            if self.detect_hands(cropped_image):
-                self.stable_frame_count = 0  # Reset stability count if hands detected
-                time.sleep(1)  # Wait before next frame capture
+            with self.stage_timer.measure('hands'):
+                hands = self.detect_hands(cropped_image, timestamp)
+            if hands:
+                self.stability_detector.reset()  # Reset stability count if hands detected
                 continue
 
-            warped_image_gray = cv2.cvtColor(warped_image, cv2.COLOR_BGR2GRAY)
-
             # Choose the image to use for stability check
-            check_image =  cv2.cvtColor(cropped_image, cv2.COLOR_BGR2GRAY) if use_larger_context else warped_image_gray
+            if use_larger_context:
+                with self.stage_timer.measure('stability'):
+                    settled = self.stability_detector.update(cv2.cvtColor(cropped_image, cv2.COLOR_BGR2GRAY), timestamp)
+            else:
+                with self.stage_timer.measure('warp'):
+                    warped_image_gray = cv2.cvtColor(self.warp(color_image), cv2.COLOR_BGR2GRAY)
+                with self.stage_timer.measure('stability'):
+                    settled = self.stability_detector.update(warped_image_gray, timestamp)
+
+            # Hand results arrive asynchronously, so only accept the frame once the model
+            # has answered for the whole stable run
+            if settled and self.hand_service.has_checked(self.stability_detector.settled_time):
+                break  # Exit loop if stability threshold reached
 
-            if self.last_stable_frame is not None:
-                # Use SSIM to compare current frame with the last stable frame
-                similarity = ssim(check_image, self.last_stable_frame)
+        if self.use_depth:
+            self.depth_frame = grabbed[2]
+        self.color_image = color_image
 
-                if similarity > self.stability_ssim_threshold:
-                    self.stable_frame_count += 1
-                    time.sleep(0.15)
-                else:
-                    print('Frame not stable')
-                    self.stable_frame_count = 0  # Reset count if frames are not similar enough
+        if use_larger_context:
+            with self.stage_timer.measure('warp'):
+                warped_image_gray = cv2.cvtColor(self.warp(color_image), cv2.COLOR_BGR2GRAY)
+        if self.show_preview:
+            cv2.imshow('Warped Image', warped_image_gray)
 
-            self.last_stable_frame = check_image
+        return warped_image_gray  # Return the grayscale warped image
 
-            cv2.imshow('Warped Image', warped_image_gray)
 
-            if self.stable_frame_count >= self.stability_threshold:
-                break  # Exit loop if stability threshold reached
+    def request_resample(self):
+        """Sample the board again on the next recognize_move, without waiting for frames here.
 
-        return warped_image_gray  # Return the grayscale warped image
+        sample_board waits for settled frames without hands, so callers on the GUI thread
+        use this and the thread running the detection does the sampling.
+        """
+        self.reference_requests.put(None)
+
+    def request_update_after_move(self, board):
+        """update_after_move on the next recognize_move, like request_resample."""
+        self.reference_requests.put(board.copy())
 
+    def _run_reference_requests(self, board):
+        # Returns whether there were any. A resample covers the updates queued with it.
+        requests = []
+        while True:
+            try:
+                requests.append(self.reference_requests.get_nowait())
+            except queue.Empty:
+                break
+        if not requests:
+            return False
+
+        if any(request is None for request in requests):
+            self.sample_board(board=board)
+        else:
+            for moved_board in requests:
+                self.update_after_move(moved_board)
+        return True
 
-    def sample_board(self, max_samples=5, baseline_samples=2):
+    def sample_board(self, max_samples=5, baseline_samples=2, board=None):
         sample_number = 0
         self.previous_frames = []
         while sample_number < max_samples:
@@ -287,7 +349,6 @@ class Camera:
             if frame is not None:
                 sample_number += 1
                 self.previous_frames.append(frame)
-                time.sleep(0.01)
 
         baseline_number = 0
         self.baseline_frames = []
@@ -296,70 +357,176 @@ class Camera:
             if frame is not None:
                 baseline_number += 1
                 self.baseline_frames.append(frame)
-                time.sleep(0.01)
 
+        self._split_reference_frames()
+        self.square_boxes = square_boxes(self.previous_frames[0].shape, pixels_per_cm=self.pixels_per_cm, extended=self.extended)
+        self.channel_boxes = channel_boxes(self.square_boxes)
+        self.ssim_band_cache = (None, [])  # (squares, bands) of ssim_bands
+        self.calculate_baseline_thresholds()
+        self.fit_board_surface(board)
+
+    def fit_board_surface(self, board=None):
+        # The board surface is fitted on the squares that are empty, the starting position by
+        # default. A failed fit keeps the previous surface, without one depth pruning waits.
+        if not self.use_depth:
+            return
+        if self.depth_occupancy is None:
+            self.depth_occupancy = DepthOccupancy(self.warp, self.square_boxes, self.frame_source.depth_scale)
+        self.depth_occupancy.calibrate(self.depth_frame, board_occupancy(board if board is not None else chess.Board()))
+
+    def _split_reference_frames(self):
         frames_as_squares = [[] for _ in range(64)]
         for frame in self.previous_frames:
-            squares = divide_into_squares(frame, extended=self.extended)
+            squares = divide_into_squares(frame, pixels_per_cm=self.pixels_per_cm, extended=self.extended)
             for j, square in enumerate(squares):
                 frames_as_squares[j].append(square)
 
         self.old_squares = frames_as_squares
-        self.calculate_baseline_thresholds()
 
+    def update_after_move(self, board, max_refreshed=16):
+        """Refresh the references of the squares touched by the last move on `board`.
+
+        Every reference frame gets its own new frame, so the thresholds of the refreshed
+        squares are computed from as many distinct samples as sample_board uses.
+
+        Squares whose difference to their references already exceeds the baseline
+        (e.g. a bumped piece or a lighting change) are refreshed too. Falls back to a
+        full sample_board when too many squares need it.
+        """
+        move = board.peek()
+        board_before = board.copy()
+        board_before.pop()
+        touched = {chess_square_to_camera_perspective(square) for square in move_squares(board_before, move)}
 
+        new_samples = [self.get_processed_frame() for _ in self.previous_frames]
+        new_baselines = [self.get_processed_frame() for _ in self.baseline_frames]
+
+        # Drift of every square of the settled board against the current references
+        self.frame = new_samples[0]
+        if self.batched_ssim:
+            drift = self.batched_square_diffs()
+        else:
+            drift = dict(self._looped_square_diffs(range(64)))
+        estimated_max = self.baseline_stats.estimated_max('overall')
+        drifted = {idx for idx in range(64) if drift[idx] > estimated_max[idx]}
+
+        refreshed = sorted(touched | drifted)
+        if len(refreshed) > max_refreshed:
+            print(f"{len(refreshed)} squares changed, resampling the whole board")
+            self.sample_board(board=board)
+            return
+
+        # New frame objects, as the old ones may still be referenced by the history
+        self.previous_frames = self._paste_squares(self.previous_frames, new_samples, refreshed)
+        self.baseline_frames = self._paste_squares(self.baseline_frames, new_baselines, refreshed)
+        self._split_reference_frames()
+        self.calculate_square_thresholds(refreshed)
+        self.fit_board_surface(board)
+
+    def _paste_squares(self, frames, new_frames, indices):
+        updated = []
+        for frame, source in zip(frames, new_frames):
+            frame = frame.copy()
+            for idx in indices:
+                top, bottom, left, right = self.square_boxes[idx]
+                frame[top:bottom, left:right] = source[top:bottom, left:right]
+            updated.append(frame)
+        return updated
 
     def calculate_baseline_thresholds(self):
         print("Computing baseline")
-        self.baseline_thresholds = {'overall': {}, 'sections': {'center': {}, 'left': {}, 'right': {}, 'top': {}, 'bottom': {}}}
 
-        # Preprocess to divide frames into squares and sections only once
-        baseline_squares_list = [divide_into_squares(frame, extended=self.extended) for frame in self.baseline_frames]
-        sample_squares_list = [divide_into_squares(frame, extended=self.extended) for frame in self.previous_frames]
+        if self.save_diagnostics:
+            self.save_square_grid('grid_separated.png')
 
-        fig, axs = plt.subplots(8, 8, figsize=(10, 10))
-        for i, ax in enumerate(axs.flatten()):
-            ax.imshow(baseline_squares_list[0][i], cmap='gray')
-            ax.axis('off')
-            print(i)
-        plt.tight_layout()
-        plt.savefig('grid_separated.png', dpi=300, bbox_inches='tight')
+        # Differences of every (baseline, sample) pair, shape (pairs, channels, 64)
+        if self.batched_ssim:
+            diffs = self._batched_baseline_diffs()
+        else:
+            diffs = self._looped_baseline_diffs()
+
+        # Seed the running statistics for overall and section differences
+        for c, channel in enumerate(self.baseline_stats.CHANNELS):
+            self.baseline_stats.reset(channel, diffs[:, c])
 
-        num_squares = len(baseline_squares_list[0])
+    def _batched_baseline_diffs(self):
+        # One SSIM map per pair, pooled for the squares and for all five sections
+        diffs = []
+        for baseline_frame in self.baseline_frames:
+            for sample_frame in self.previous_frames:
+                diffs.append((1 - self.ssim_kernel.scores(baseline_frame, sample_frame, self.channel_boxes)) * 100)
 
-        for idx in range(num_squares):
-            overall_diffs, section_diffs = [], {'center': [], 'left': [], 'right': [], 'top': [], 'bottom': []}
+        return np.array(diffs)
 
-            for baseline_square in [squares[idx] for squares in baseline_squares_list]:
-                baseline_sections = split_into_sections(baseline_square)
+    def _looped_baseline_diffs(self):
+        # Preprocess to divide frames into squares and sections only once
+        baseline_squares_list = [divide_into_squares(frame, pixels_per_cm=self.pixels_per_cm, extended=self.extended) for frame in self.baseline_frames]
+        sample_squares_list = [divide_into_squares(frame, pixels_per_cm=self.pixels_per_cm, extended=self.extended) for frame in self.previous_frames]
+
+        diffs = []
+        for baseline_squares in baseline_squares_list:
+            for sample_squares in sample_squares_list:
+                overall_row, section_rows = [], {section: [] for section in SECTIONS}
 
-                for sample_square in [squares[idx] for squares in sample_squares_list]:
+                for baseline_square, sample_square in zip(baseline_squares, sample_squares):
+                    baseline_sections = split_into_sections(baseline_square)
                     sample_sections = split_into_sections(sample_square)
 
                     # Calculate overall SSIM
                     overall_score, _ = ssim(baseline_square, sample_square, full=True)
-                    overall_diffs.append( (1 - overall_score)*100)
+                    overall_row.append((1 - overall_score) * 100)
 
                     # Calculate section SSIMs
-                    for section in section_diffs.keys():
+                    for section in section_rows:
                         section_score, _ = ssim(baseline_sections[section], sample_sections[section], full=True)
-                        section_diffs[section].append((1 - section_score)*100)
+                        section_rows[section].append((1 - section_score) * 100)
+
+                diffs.append([overall_row] + [section_rows[section] for section in SECTIONS])
 
-            # Calculate metrics for overall and section differences
-            self.baseline_thresholds['overall'][idx] = calculate_threshold_metrics(overall_diffs)
-            for section in section_diffs:
-                self.baseline_thresholds['sections'][section][idx] = calculate_threshold_metrics(section_diffs[section])
+        return np.array(diffs)
+
+    def calculate_square_thresholds(self, indices):
+        # Same statistics as calculate_baseline_thresholds, only for the given squares.
+        # Maps are computed per tile, so the cost grows with the number of squares.
+        for idx in indices:
+            top, bottom, left, right = self.square_boxes[idx]
+            tile_boxes = channel_boxes(np.array([[0, bottom - top, 0, right - left]]))
+
+            diffs = []
+            for baseline_frame in self.baseline_frames:
+                for sample_frame in self.previous_frames:
+                    scores = self.tile_ssim_kernel.scores(baseline_frame[top:bottom, left:right], sample_frame[top:bottom, left:right], tile_boxes)
+                    diffs.append((1 - scores) * 100)
+            diffs = np.array(diffs)  # (pairs, channels, 1)
+
+            for c, channel in enumerate(self.baseline_stats.CHANNELS):
+                self.baseline_stats.reset(channel, diffs[:, c], squares=[idx])
+
+    def update_baseline_statistics(self):
+        # The frame compared last is idle (nothing changed), so its differences against
+        # every reference are new samples of the noise. Lets thresholds follow slow drift.
+        self.baseline_stats.update_idle(self.frame_diffs)
+
+    def save_square_grid(self, filename):
+        # Diagnostics only, enable with save_diagnostics
+        baseline_squares = divide_into_squares(self.baseline_frames[0], pixels_per_cm=self.pixels_per_cm, extended=self.extended)
+        fig, axs = plt.subplots(8, 8, figsize=(10, 10))
+        for i, ax in enumerate(axs.flatten()):
+            ax.imshow(baseline_squares[i], cmap='gray')
+            ax.axis('off')
+        plt.tight_layout()
+        plt.savefig(filename, dpi=300, bbox_inches='tight')
+        plt.close(fig)
 
+    def get_move_index(self, board):
+        """Legal moves of the position by camera square pair, built once per ply."""
+        if self.move_index is None or self.move_index.fen != board.fen():
+            self.move_index = LegalMoveIndex(board)
+        return self.move_index
 
     def get_relevant_squares(self, board):
         """Get squares relevant to the current turn."""
-        relevant_squares = set()
-        for move in board.legal_moves:
-            if board.color_at(move.from_square) == board.turn:
-                relevant_squares.add(chess_square_to_camera_perspective(move.from_square))
-                relevant_squares.add(chess_square_to_camera_perspective(move.to_square))
-
-        return relevant_squares
+        return self.get_move_index(board).relevant_squares
     
     ##################
     # MOVE DETECTION #
@@ -369,11 +536,80 @@ class Camera:
         self.frame = self.get_processed_frame()
         ssim_squares = self.ssim_square(board)
         detailed_squares = self.ssim_small(ssim_squares)
+
+        # Nothing above the thresholds, so the frame is an idle sample
+        if self.batched_ssim and not ssim_squares:
+            self.update_baseline_statistics()
+
         return detailed_squares
 
+    def classify_squares(self, board):
+        """Change mask and evidence of every square from the classifier, in one batch."""
+        self.frame = self.get_processed_frame()
+        with self.stage_timer.measure('classify'):
+            probabilities = self.square_classifier.predict(self.frame, self.previous_frames, self.square_boxes)
+
+        relevant = np.zeros(64, dtype=bool)
+        relevant[list(self.get_relevant_squares(board))] = True
+        mask = relevant & (probabilities > self.classifier_threshold)
+
+        with self.stage_timer.measure('heatmap'):
+            self._update_heatmap([(idx, probabilities[idx] * 100) for idx in np.flatnonzero(relevant)], 0)
+            self._update_detailed_heatmap([])
+
+        # Same scale as the SSIM evidence, so move_margin keeps its meaning
+        return mask, np.where(mask, probabilities * 100, 0)
+
+    def batched_square_diffs(self, squares=range(64)):
+        """Average SSIM difference of `squares` against the reference samples, NaN for the others."""
+        # Sections are pooled from the same maps and kept for ssim_small, shape (references, channels, 64)
+        self.frame_diffs = np.full((len(self.previous_frames), len(self.channel_boxes), 64), np.nan)
+        for old_frame, diffs in zip(self.previous_frames, self.frame_diffs):
+            for rows, cols, indices, boxes in self.ssim_bands(squares):
+                diffs[:, indices] = (1 - self.ssim_kernel.scores(old_frame[rows, cols], self.frame[rows, cols], boxes)) * 100
+        return self.frame_diffs[:, 0].mean(axis=0)
+
+    def ssim_bands(self, squares):
+        """Crops of the board covering `squares` one board row at a time, as (rows, cols, squares, boxes in the crop).
+
+        Pooling only reads the map inside each square, so maps computed on these crops give
+        the same scores as a map of the whole board for the fraction of the pixels.
+        """
+        key = tuple(sorted(squares))
+        if self.ssim_band_cache[0] != key:
+            squares = np.array(key, dtype=np.int64)
+            bands = []
+            for row in np.unique(squares // 8):
+                indices = squares[squares // 8 == row]
+                boxes = self.square_boxes[indices]
+                top, bottom, left, right = boxes[:, 0].min(), boxes[:, 1].max(), boxes[:, 2].min(), boxes[:, 3].max()
+                bands.append((slice(top, bottom), slice(left, right), indices, self.channel_boxes[:, indices] - [top, top, left, left]))
+            self.ssim_band_cache = (key, bands)
+        return self.ssim_band_cache[1]
+
+    def batched_section_diffs(self):
+        """Average SSIM difference of every square section, from the maps of batched_square_diffs."""
+        return {section: self.frame_diffs[:, c + 1].mean(axis=0) for c, section in enumerate(SECTIONS)}
+
     def ssim_square(self, board):
         relevant_squares = self.get_relevant_squares(board)
-        new_squares = divide_into_squares(self.frame, extended=self.extended)
+
+        with self.stage_timer.measure('square_ssim'):
+            if self.batched_ssim:
+                all_diffs = self.batched_square_diffs(relevant_squares)
+                square_diffs = [(idx, all_diffs[idx]) for idx in relevant_squares]
+            else:
+                square_diffs = self._looped_square_diffs(relevant_squares)
+        avg_diff = square_diffs[-1][1] if square_diffs else 0
+
+        with self.stage_timer.measure('heatmap'):
+            self._update_heatmap(square_diffs, avg_diff)
+
+        # Sort and filter based on overall changes
+        return select_changed_squares(square_diffs, self.baseline_stats.estimated_max('overall'), self.large_threshold)
+
+    def _looped_square_diffs(self, relevant_squares):
+        new_squares = divide_into_squares(self.frame, pixels_per_cm=self.pixels_per_cm, extended=self.extended)
 
         square_diffs = []
         for idx in relevant_squares:
@@ -389,183 +625,141 @@ class Camera:
                 avg_diff = sum(diffs) / len(diffs) if diffs else 0
                 square_diffs.append((idx, avg_diff))
 
-        self._update_heatmap(square_diffs, avg_diff)
-
-        # Sort and filter based on overall changes
-        square_diffs.sort(key=lambda x: x[1], reverse=True)
-        #return [(idx, avg_diff) for idx, avg_diff in square_diffs if (avg_diff > self.large_threshold)]
+        return square_diffs
 
-        return [(idx, avg_diff) for idx, avg_diff in square_diffs if avg_diff > self.baseline_thresholds['overall'][idx]['estimated_max'] and avg_diff > self.large_threshold ]
+    def ssim_small(self, squares):
+        start = time.perf_counter()
+        if self.batched_ssim:
+            section_diffs = self.batched_section_diffs()
+            section_diffs_of = lambda idx: {section: diffs[idx] for section, diffs in section_diffs.items()}
+        else:
+            new_squares = divide_into_squares(self.frame, pixels_per_cm=self.pixels_per_cm, extended=self.extended)
+            section_diffs_of = lambda idx: self._looped_section_diffs(idx, new_squares[idx])
 
-    def ssim_small(self, squares, detailed_threshold=6):
-        new_squares = divide_into_squares(self.frame, extended=self.extended)
+        center_max = self.baseline_stats.estimated_max('center')
+        section_medians = {section: self.baseline_stats.median(section) for section in SECTIONS}
+        detailed_square_diffs = select_detailed_squares(squares[:self.detailed_threshold], section_diffs_of, center_max, section_medians)
 
-        detailed_square_diffs = []
-        added_indices = set()  # To keep track of added square indices
+        self.stage_timer.add('section_ssim', time.perf_counter() - start)
 
-        for idx, avg_diff in squares[:detailed_threshold]:
-            new = new_squares[idx]
-            new_sections = split_into_sections(new)
-            # Visualize the sections
-            diffs = {'center': 0, 'left': 0, 'right': 0, 'top': 0, 'bottom': 0}
-            for old_sample in self.old_squares[idx]:
-                if old_sample is not None:
-                    old_sections = split_into_sections(old_sample)
-                    for section in new_sections:
-                        score, _ = ssim(old_sections[section], new_sections[section], full=True)
-                        diff = (1 - score) * 100
-                        diffs[section] += diff
-            avg_diffs = {section: diffs[section] / len(self.old_squares[idx]) for section in diffs}
-            # Only append if the max difference is larger than the small threshold
-            #if max(avg_diffs.values()) > self.small_threshold:
-            #    detailed_square_diffs.append((idx, avg_diff, avg_diffs))
-
-            center_exceeds_threshold = avg_diffs['center'] > self.baseline_thresholds['sections']['center'][idx]['estimated_max']
-            right_exceeds_threshold = avg_diffs['right'] > self.baseline_thresholds['sections']['right'][idx]['median']
-            left_exceeds_threshold = avg_diffs['left'] > self.baseline_thresholds['sections']['left'][idx]['median']
-            top_exceeds_threshold = avg_diffs['top'] > self.baseline_thresholds['sections']['top'][idx]['median']
-            bottom_exceeds_threshold = avg_diffs['bottom'] > self.baseline_thresholds['sections']['bottom'][idx]['median']
-
-            #########################################################################################
-            # THIS SHOULD BE TESTED MORE, PROBABLY ADDING SOME ML THAT LEARNS IT WOULD BE BETTER
-            #########################################################################################
-                
-            # Determine the condition to append the square or its right neighbor to detailed_square_diffs
-            if center_exceeds_threshold:
-                detailed_square_diffs.append((idx, avg_diff, avg_diffs))
-                added_indices.add(idx)
-            elif right_exceeds_threshold and not left_exceeds_threshold:
-                # Append the right adjacent square index if available, considering board limits
-                right_idx = self._get_right_adjacent_square_index(idx)
-                if right_idx is not None and right_idx not in added_indices:
-                    detailed_square_diffs.append((right_idx, avg_diff, avg_diffs))
-
-        self._update_detailed_heatmap(detailed_square_diffs)
+        with self.stage_timer.measure('heatmap'):
+            self._update_detailed_heatmap(detailed_square_diffs)
 
         return detailed_square_diffs
     
 
-    def _get_right_adjacent_square_index(self, current_idx):
-        # Calculate the right adjacent square index based on current index and board dimensions
-        # Assuming standard 8x8 chess board and idx starting from 0 at the top left square
-        # You might need to adjust this based on how your board is represented
-        row_size = 8  # Typically, a chess board row has 8 squares
-        if (current_idx + 1) % row_size != 0:  # Not on the right edge
-            return current_idx + 1  # The right adjacent square
-        else:
-            return None  # Right edge, no adjacent square to the right
-        
+    def _looped_section_diffs(self, idx, new):
+        new_sections = split_into_sections(new)
+        diffs = {'center': 0, 'left': 0, 'right': 0, 'top': 0, 'bottom': 0}
+        for old_sample in self.old_squares[idx]:
+            if old_sample is not None:
+                old_sections = split_into_sections(old_sample)
+                for section in new_sections:
+                    score, _ = ssim(old_sections[section], new_sections[section], full=True)
+                    diff = (1 - score) * 100
+                    diffs[section] += diff
+        return {section: diffs[section] / len(self.old_squares[idx]) for section in diffs}
+
     def recognize_move(self, board):
-        # Get the squares that have changed along with their details
-        changed_squares_with_details = self.compare_squares(board)
+        with self.stage_timer.measure('recognize'):
+            move = self._recognize_move(board)
+        self.stage_timer.maybe_dump()
+        return move
+
+    def _recognize_move(self, board):
+        # References taken before the camera moved are useless, start over
+        if self.check_drift():
+            self.sample_board(board=board)
+            return None
 
-        if len(changed_squares_with_details) == 0:
+        if self._run_reference_requests(board):
             return None
-        
-        #self._update_detailed_heatmap(changed_squares_with_details)
-
-        # Calculate scores for each square based on detailed section differences
-        #square_scores = {}
-        #for idx, _, section_diffs in changed_squares_with_details:
-        #    left_idx = idx - 1 if idx % 8 != 0 else None  # Get the left square index if it exists
-        #    left_diffs = next((details for idy, _, details in changed_squares_with_details if idy == left_idx), None) if left_idx is not None else None
-        #    score = section_diffs['center'] + section_diffs['right']
-        #    if left_diffs:
-        #        score += left_diffs['left']
-        #    square_scores[idx] = score
-
-        square_scores = {}
-        for idx, _, section_diffs in changed_squares_with_details:
-            right_idx = idx + 1 if idx % 8 != 7 else None  # Get the right square index if it exists
-            right_diffs = next((details for idy, _, details in changed_squares_with_details if idy == right_idx), None) if right_idx is not None else None
-
-            score = section_diffs['center'] + section_diffs['left']
-            if right_diffs:
-                score += right_diffs['right']
-            square_scores[idx] = score
-
-        # Filter out only legal moves and calculate their scores
-        legal_moves = []
-        castling_moves = []
-        for from_sq, from_score in square_scores.items():
-            #from_sq = chess.SQUARES[from_sq]
-            for to_sq, to_score in square_scores.items():
-                #to_sq = chess.SQUARES[to_sq]
-                if from_sq != to_sq:
-                    move = chess.Move.from_uci(f"{index_to_algebraic(from_sq)}{index_to_algebraic(to_sq)}")
-                    promotion_move = chess.Move.from_uci(f"{index_to_algebraic(from_sq)}{index_to_algebraic(to_sq)}q")
-                    if move in board.legal_moves:
-                        legal_moves.append((move, from_score + to_score))
-                        if board.is_castling(move):
-                            castling_moves.append((move, from_score + to_score))
-                    elif promotion_move in board.legal_moves:
-                        legal_moves.append((promotion_move, from_score + to_score))
-
-        # Check for castling
-        if board.has_castling_rights(board.turn):
-            square_scores = {idx: sum(section_diffs.values()) for idx, _, section_diffs in changed_squares_with_details}
-            kingside_squares = [algebraic_to_index('e1'), algebraic_to_index('f1'), algebraic_to_index('g1'), algebraic_to_index('h1') ] if board.turn == chess.WHITE else [algebraic_to_index('e8'), algebraic_to_index('f8'), algebraic_to_index('g8'), algebraic_to_index('h8') ]
-            queenside_squares = [algebraic_to_index('e1'), algebraic_to_index('d1'), algebraic_to_index('c1'), algebraic_to_index('a1')] if board.turn == chess.WHITE else [algebraic_to_index('e8'), algebraic_to_index('d8'), algebraic_to_index('c8'), algebraic_to_index('a8')]
-            
-            kingside_move = chess.Move.from_uci("e1g1" if board.turn == chess.WHITE else "e8g8")
-            queenside_move = chess.Move.from_uci("e1c1" if board.turn == chess.WHITE else "e8c8")
-
-            if all(square_scores.get(sq, 0) > 25 for sq in kingside_squares) and kingside_move in board.legal_moves:
-                self.correct_moves += 1
-                self.add_to_history(self.frame, self.previous_frames, self.heatmap.get_array(), self.detailed_heatmap_data)
-                return kingside_move
-            if all(square_scores.get(sq, 0) > 25 for sq in queenside_squares) and queenside_move in board.legal_moves:
-                self.correct_moves += 1
-                self.add_to_history(self.frame, self.previous_frames, self.heatmap.get_array(), self.detailed_heatmap_data)
-                return queenside_move
-
-        # Sort moves by their calculated score
-        refined_moves = sorted(legal_moves, key=lambda x: x[1], reverse=True)
+
+        if self.square_classifier is not None:
+            mask, evidence = self.classify_squares(board)
+            if not mask.any():
+                return None
+            with self.stage_timer.measure('move_scoring'):
+                refined_moves = rank_moves_by_evidence(self.get_move_index(board), mask, evidence)
+        else:
+            # Get the squares that have changed along with their details
+            changed_squares_with_details = self.compare_squares(board)
+
+            if len(changed_squares_with_details) == 0:
+                return None
+
+            # Score all legal moves at once, castling and en passant included
+            with self.stage_timer.measure('move_scoring'):
+                refined_moves = rank_moves(self.get_move_index(board), changed_squares_with_details)
 
         if len(refined_moves) == 0:
             return None
-        
-        if False:
-            # Save the movement square and split just for visualization
-            from_square_idx = refined_moves[0][0].from_square
-            to_square_idx = refined_moves[0][0].to_square
-
-            # Save the 'from' square image
-            from_square_image = self.old_squares[from_square_idx][-1]
-            cv2.imwrite('movement_from_square.png', from_square_image)
-
-            # Save the 'to' square image
-            to_square_image = self.old_squares[to_square_idx][-1]
-            cv2.imwrite('movement_to_square.png', to_square_image)
-
-            # Save the split sections of the 'from' square
-            from_square_sections = split_into_sections(from_square_image)
-            for section, img in from_square_sections.items():
-                cv2.imwrite(f'movement_from_{section}.png', img)
-
-            # Save the split sections of the 'to' square
-            to_square_sections = split_into_sections(to_square_image)
-            for section, img in to_square_sections.items():
-                cv2.imwrite(f'movement_to_{section}.png', img)
-
-        
-        self.correct_moves += 1
-        self.add_to_history(self.frame, self.previous_frames, self.heatmap.get_array(), self.detailed_heatmap_data)
 
-        if len(refined_moves) == 1:
-            return refined_moves[0][0]
-        
-        # If refined move difference between first and second is higher than 30, return the first move
-        if len(refined_moves) > 1 and refined_moves[0][1] - refined_moves[1][1] > 50:
-            return refined_moves[0][0]
+        if self.depth_occupancy is not None and self.depth_occupancy.fitted:
+            refined_moves = self.prune_by_occupancy(board, refined_moves)
+            if len(refined_moves) == 0:
+                return None
 
-        # Return the top 5 moves (if more than one) with the highest score
-        return [move for move, _ in refined_moves[:5]]
+        if len(refined_moves) > 1 and refined_moves[0][2] <= self.move_margin and self.piece_identifier is not None:
+            refined_moves = self.prune_by_piece(board, refined_moves)
+
+        self.correct_moves += 1
+        self.add_to_history(board, refined_moves)
+
+        return pick_move(refined_moves, self.move_margin)
+
+    def piece_crop(self, idx):
+        # The square with half a square around it, pieces reach into their neighbours
+        top, bottom, left, right = self.square_boxes[idx]
+        margin_y, margin_x = (bottom - top) // 2, (right - left) // 2
+        height, width = self.frame.shape[:2]
+        return self.frame[max(0, top - margin_y):min(height, bottom + margin_y), max(0, left - margin_x):min(width, right + margin_x)]
+
+    def prune_by_piece(self, board, refined_moves):
+        """Drop candidates whose piece is not the one recognized on their destination."""
+        to_squares = sorted({move.to_square for move, _, _ in refined_moves})
+        crops = [self.piece_crop(chess_square_to_camera_perspective(square)) for square in to_squares]
+        seen = dict(zip(to_squares, self.piece_identifier.identify(crops)))
+
+        def consistent(move):
+            piece = seen[move.to_square]
+            if piece is None:
+                return True  # Not recognized, keep the candidate
+            moved = board.piece_at(move.from_square)
+            piece_type = move.promotion or moved.piece_type
+            return piece.piece_type == piece_type and piece.color == moved.color
+
+        kept = [candidate for candidate in refined_moves if consistent(candidate[0])]
+        return with_margins(kept) if kept else refined_moves
+
+    def prune_by_occupancy(self, board, refined_moves):
+        """Keep the candidates that agree best with the occupied squares seen in depth.
+
+        A candidate contradicted on every square it touches is dropped even if it is the
+        only one, so a move is not accepted while depth shows the old position.
+        """
+        observed = self.depth_occupancy.occupancy(self.depth_frame)
+
+        mismatches = []
+        for move, _, _ in refined_moves:
+            after = board.copy(stack=False)
+            after.push(move)
+            touched = [chess_square_to_camera_perspective(square) for square in move_squares(board, move)]
+            wrong = np.count_nonzero(board_occupancy(after)[touched] != observed[touched])
+            mismatches.append(wrong if wrong < len(touched) else None)
+
+        fewest = min((wrong for wrong in mismatches if wrong is not None), default=None)
+        return with_margins([candidate for candidate, wrong in zip(refined_moves, mismatches) if wrong is not None and wrong == fewest])
 
     ##################
     # GETTER/SETTERS #
     ##################
 
+    def close(self):
+        self.grabber.stop()
+        self.hand_service.close()
+        self.archiver.close()
+
     def pause_camera(self):
         self.is_active = False
 
@@ -588,76 +782,44 @@ class Camera:
         print("-"*20)
         print(f"Correct moves: {self.correct_moves}")
         print(f"Wrong moves: {self.wrong_moves}")
+        gate_stats = self.motion_gate.stats()
+        print(f"Motion gate: {gate_stats['frames']} frames, {gate_stats['motion_rate']:.1%} motion, {gate_stats['open_rate']:.1%} sent to hand model")
+        print(self.stage_timer.format())
         print()
 
     ##############
     # STATISTICS #
     ##############
     
-    def add_to_history(self, frame, previous_turn_samples, heatmap_data, detailed_heatmaps):
-        if len(self.frame_history) >= self.max_history:
-            self.frame_history.pop(0)
-        self.frame_history.append((frame, previous_turn_samples, heatmap_data, detailed_heatmaps))
+    def add_to_history(self, board, refined_moves):
+        # Diffs of the SSIM path, the classifier has none
+        diffs = self.frame_diffs.mean(axis=0) if self.batched_ssim and self.square_classifier is None else np.nan
+        candidates = refined_moves[:MAX_CANDIDATES]
+        self.frame_history.add(
+            self.frame, self.previous_frames,
+            timestamp=time.time(), pixels_per_cm=self.pixels_per_cm, extended=self.extended,
+            fen=board.fen().encode(),
+            candidates=[move.uci().encode() for move, _, _ in candidates] + [b''] * (MAX_CANDIDATES - len(candidates)),
+            scores=[score for _, score, _ in candidates] + [0] * (MAX_CANDIDATES - len(candidates)),
+            large_threshold=self.large_threshold, small_threshold=self.small_threshold, move_margin=self.move_margin,
+            diffs=diffs,
+            estimated_max=[self.baseline_stats.estimated_max(channel) for channel in self.baseline_stats.CHANNELS],
+            heatmap=self.heatmap_data,
+            detailed_heatmaps=[self.detailed_heatmap_data[section] for section in SECTIONS],
+        )
 
     def archive_wrong_move(self, num_moves_to_pop):
-        while num_moves_to_pop > 0 and self.frame_history:
+        while num_moves_to_pop > 0 and len(self.frame_history):
             num_moves_to_pop -= 1
 
-            # Pop the oldest record in the history
-            current_frame, previous_turn_samples, main_heatmap_data, detailed_heatmap_data = self.frame_history.pop(0)
-
-            # Create a folder for this wrong move
-            wrong_move_folder = os.path.join(self.wrong_moves_folder, f"wrong_move_{time.strftime('%Y%m%d-%H%M%S')}")
-            os.makedirs(wrong_move_folder, exist_ok=True)
-
-            # Save the current frame
-            cv2.imwrite(os.path.join(wrong_move_folder, "current_frame.jpg"), current_frame)
-
-            # Save the previous turn samples
-            for i, prev_frame in enumerate(previous_turn_samples):
-                cv2.imwrite(os.path.join(wrong_move_folder, f"prev_turn_sample_{i}.jpg"), prev_frame)
-
-            # Save the combined heatmap
-            self.save_combined_heatmap(os.path.join(wrong_move_folder, "combined_heatmap.png"), main_heatmap_data, detailed_heatmap_data)
+            # Pop the oldest record in the history, the archiver appends it to the archive
+            self.archiver.submit(self.frame_history.pop_oldest())
 
             # Update wrong moves count
         self.wrong_moves += 1
         self.correct_moves -= 1
         self.print_stats()
 
-    def save_combined_heatmap(self, filename, main_heatmap_data, detailed_heatmap_data):
-        # Create a figure with GridSpec layout
-        fig = plt.figure(figsize=(15, 10))
-        gs = gridspec.GridSpec(2, 4, width_ratios=[1, 1, 1, 0.05])
-
-        # Create main heatmap subplot
-        ax_main = plt.subplot(gs[0, 0])
-        ax_main.imshow(main_heatmap_data, interpolation='nearest', vmin=0, vmax=50, cmap='jet')
-        ax_main.set_title("Main Heatmap")
-        ax_main.set_xticks(range(8))
-        ax_main.set_yticks(range(8))
-
-        # Create detailed heatmaps based on positions used in _init_heatmaps
-        detailed_heatmap_positions = {
-            'center': (0, 1), 'top': (0, 2), 
-            'left': (1, 0), 'right': (1, 1), 'bottom': (1, 2)
-        }
-
-        for section, pos in detailed_heatmap_positions.items():
-            ax = plt.subplot(gs[pos])
-            ax.imshow(detailed_heatmap_data[section], interpolation='nearest', vmin=0, vmax=50, cmap='jet')
-            ax.set_title(section.capitalize())
-            ax.set_xticks(range(8))
-            ax.set_yticks(range(8))
-
-            ax.set_xticklabels(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'])
-            ax.set_yticklabels(['8', '7', '6', '5', '4', '3', '2', '1'])
-
-        # Add colorbar
-        cb_ax = plt.subplot(gs[:, -1])
-        plt.colorbar(ax_main.get_images()[0], cax=cb_ax)
-
-        # Save the figure
-        plt.tight_layout()
-        plt.savefig(filename)
-        plt.close(fig)
\ No newline at end of file
+    def record_correction(self, board, move):
+        """Store the move the user entered on `board` with the wrong detections of that position."""
+        self.archiver.correct(board.fen(), move)
@@ -54,6 +54,10 @@ class ChessController(threading.Thread):
             # Check for castling
             is_castling_move = self.board.is_castling(move)
 
+            # In correction mode this is the move the camera got wrong, stored with its archived frames
+            if self.camera and self.in_correction_mode:
+                self.camera.record_correction(self.board, move)
+
             # Make the move and update the GUI
             self.board.push(move)
             self.gui.update_display(self.board.fen(), last_move=move)
@@ -95,12 +99,14 @@ class ChessController(threading.Thread):
                 self.send_move_robot(move_kill, is_checkmate=True, is_pawn=current_is_pawn)
             
             if self.camera and not self.in_correction_mode:
+                # Only the squares touched by the move are re-referenced, by the detection
+                # thread, which is the only one reading frames
                 if self.game_mode == "human-human":
-                    self.camera.sample_board()
+                    self.camera.request_update_after_move(self.board)
                     self.camera.print_stats()
  
                 elif self.game_mode == "human-engine":
-                    self.camera.sample_board()
+                    self.camera.request_update_after_move(self.board)
                     self.camera.print_stats()
 
         else:
@@ -172,7 +178,7 @@ class ChessController(threading.Thread):
             self.robot_movement = False
 
         if self.camera:
-            self.camera.sample_board()
+            self.camera.request_resample()
 
     def handle_wrong_move(self):
         # If it's the robot's (engine's) turn, pop only the last move
@@ -187,14 +193,16 @@ class ChessController(threading.Thread):
 
         if self.camera is not None:
             self.camera.archive_wrong_move(num_moves_to_pop)
-            self.camera.sample_board()
+            # Done by the detection thread, the button returns immediately
+            self.camera.request_resample()
 
     def exit_correction_mode(self):
         self.in_correction_mode = False
 
         if self.camera:
-            # Sample the board for the previous turn, effectively resetting the detection state
-            self.camera.sample_board()
+            # Sample the board for the previous turn, effectively resetting the detection state.
+            # Done by the detection thread, the button returns immediately
+            self.camera.request_resample()
 
         if self.game_mode == "human-engine" and not self.board.turn != self.player_color:
             # If it's the robot's turn after exiting correction mode, get the engine's move
@@ -0,0 +1,72 @@
+import cv2
+import numpy as np
+from cam_utils import section_boxes, CAMERA_TO_SQUARE
+
+
+def board_occupancy(board):
+    """Occupied squares of a chess.Board, by camera index."""
+    occupied = np.array([(board.occupied >> square) & 1 for square in range(64)], dtype=bool)
+    return occupied[CAMERA_TO_SQUARE]
+
+
+class DepthOccupancy:
+    """Piece presence per square from depth frames aligned to the colour frames.
+
+    Depth goes through the same warp as the colour frames, with nearest neighbour
+    interpolation so no heights are invented at piece edges. The board surface is a
+    quadratic fitted to the centre depths of the squares known to be empty, and a square
+    is occupied when its centre rises more than `min_height_mm` above it. Pixels without
+    depth (zeros) are ignored, squares without any valid pixel count as empty.
+    """
+
+    def __init__(self, warp, boxes, depth_scale, min_height_mm=15):
+        self.warp = warp
+        self.depth_scale = depth_scale
+        self.min_height_mm = min_height_mm
+
+        self.center_boxes = section_boxes(boxes)['center']
+        top, bottom, left, right = self.center_boxes.T
+        y, x = (top + bottom) / 2 / warp.shape[0], (left + right) / 2 / warp.shape[1]
+        self.design = np.stack([np.ones(64), x, y, x * x, y * y, x * y], axis=1)
+        self.surface = None
+
+    def square_depths(self, depth):
+        """Mean depth in millimetres of the centre of every square, NaN without valid pixels."""
+        warped = self.warp(depth, interpolation=cv2.INTER_NEAREST)
+        millimetres = warped.astype(np.float64) * (self.depth_scale * 1000)
+        valid = (warped > 0).astype(np.float64)
+
+        top, bottom, left, right = self.center_boxes.T
+        def box_sums(image):
+            integral = cv2.integral(image, sdepth=cv2.CV_64F)
+            return integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+
+        counts = box_sums(valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, box_sums(millimetres) / counts, np.nan)
+
+    @property
+    def fitted(self):
+        return self.surface is not None
+
+    def calibrate(self, depth, occupied):
+        """Fit the board surface on the squares that are empty according to `occupied`.
+
+        Returns False and keeps the previous surface (if any) when too few are empty.
+        """
+        depths = self.square_depths(depth)
+        empty = ~occupied & np.isfinite(depths)
+        if empty.sum() < self.design.shape[1]:
+            print("Not enough empty squares to fit the board surface")
+            return False
+
+        coefficients, *_ = np.linalg.lstsq(self.design[empty], depths[empty], rcond=None)
+        self.surface = self.design @ coefficients
+        return True
+
+    def heights(self, depth):
+        """Height in millimetres of every square centre above the board surface."""
+        return np.nan_to_num(self.surface - self.square_depths(depth))
+
+    def occupancy(self, depth):
+        return self.heights(depth) > self.min_height_mm
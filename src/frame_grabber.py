@@ -0,0 +1,143 @@
+import threading
+import numpy as np
+
+
+class FrameGrabber(threading.Thread):
+    """Drains a FrameSource into a ring buffer holding the newest frames.
+
+    When consumers are slower than the camera the oldest frames are overwritten,
+    so processing always works on recent data instead of a growing backlog. Lossless
+    sources (unthrottled replays) instead wait until the consumer caught up. If the
+    source raises, the thread stops and the exception is raised again in the consumer.
+    """
+
+    def __init__(self, source, capacity=4):
+        super().__init__(daemon=True)
+        self.source = source
+        self.capacity = capacity
+        self.lossless = source.lossless
+
+        # Preallocated slots, reused for the whole session
+        self.frames = np.empty((capacity,) + tuple(source.frame_shape), dtype=np.uint8)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        # Aligned depth of every slot, for sources that have it
+        self.has_depth = source.depth_shape is not None
+        self.depth_frames = np.empty((capacity,) + tuple(source.depth_shape), dtype=np.uint16) if self.has_depth else None
+
+        self.frame_count = 0  # Total frames written, the newest is at (frame_count - 1) % capacity
+        self.read_count = 0   # Frames handed out or skipped by consumers
+        self.condition = threading.Condition()
+        self.running = True
+        self.error = None  # Exception the source raised, see _raise_error
+
+    def run(self):
+        try:
+            while self.running:
+                image, timestamp = self.source.read()
+
+                if image is None:
+                    if self.source.finished:
+                        break
+                    continue
+
+                depth = self.source.read_depth() if self.has_depth else None
+                self._write(image, timestamp, depth)
+        except Exception as e:
+            # E.g. a USB timeout in wait_for_frames
+            self.error = e
+        finally:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        self.join(timeout=1)
+        self.source.stop()
+
+    def _write(self, image, timestamp, depth=None):
+        with self.condition:
+            if self.lossless:
+                self.condition.wait_for(lambda: self.frame_count - self.read_count < self.capacity or not self.running)
+
+            slot = self.frame_count % self.capacity
+            np.copyto(self.frames[slot], image)
+            if depth is not None:
+                np.copyto(self.depth_frames[slot], depth)
+            self.timestamps[slot] = timestamp
+            self.frame_count += 1
+            self.condition.notify_all()
+
+    @property
+    def exhausted(self):
+        # The source finished and every buffered frame was handed out
+        with self.condition:
+            return not self.running and self.read_count >= self.frame_count
+
+    def _raise_error(self):
+        # Consumers waiting on a dead grabber would otherwise only ever time out
+        if self.error is not None:
+            raise self.error
+
+    def _buffered_frames(self):
+        # Numbers of the frames still in the buffer, oldest first
+        first = max(0, self.frame_count - self.capacity)
+        return range(first, self.frame_count)
+
+    def _take(self, slot, depth):
+        # Copies of a slot, as the grabber thread will overwrite it
+        if depth:
+            return self.frames[slot].copy(), self.timestamps[slot], self.depth_frames[slot].copy()
+        return self.frames[slot].copy(), self.timestamps[slot]
+
+    def latest(self, after=None, timeout=1.0, depth=False):
+        """Newest frame, waiting for one newer than `after` if given.
+
+        Returns (frame, timestamp), or (None, None) on timeout. With `depth` the aligned
+        depth frame is returned as a third element. Raises the exception the source
+        raised once the grabber stopped on it.
+        """
+        if self.lossless:
+            # Nothing is skipped, the consumer gets frames in order
+            return self.next_after(-np.inf if after is None else after, timeout, depth)
+
+        with self.condition:
+            def ready():
+                if self.error is not None:
+                    return True
+                if self.frame_count == 0:
+                    return False
+                return after is None or self.timestamps[(self.frame_count - 1) % self.capacity] > after
+
+            if not self.condition.wait_for(ready, timeout):
+                return (None, None, None) if depth else (None, None)
+            self._raise_error()
+
+            slot = (self.frame_count - 1) % self.capacity
+            self.read_count = self.frame_count
+            self.condition.notify_all()
+            return self._take(slot, depth)
+
+    def next_after(self, after, timeout=1.0, depth=False):
+        """Oldest buffered frame newer than `after`, waiting for it if needed.
+
+        Frames that were overwritten before being read are skipped. Returns
+        (frame, timestamp), or (None, None) on timeout. Raises like latest().
+        """
+        with self.condition:
+            def newer_frame():
+                for i in self._buffered_frames():
+                    if self.timestamps[i % self.capacity] > after:
+                        return i
+                return None
+
+            if not self.condition.wait_for(lambda: self.error is not None or newer_frame() is not None, timeout):
+                return (None, None, None) if depth else (None, None)
+            self._raise_error()
+
+            i = newer_frame()
+            self.read_count = max(self.read_count, i + 1)
+            self.condition.notify_all()
+            return self._take(i % self.capacity, depth)
@@ -0,0 +1,99 @@
+import queue
+import threading
+import numpy as np
+from misdetection_archive import RECORD_DTYPE
+
+
+class FrameHistory:
+    """The last `capacity` detections: frame, reference samples and a RECORD_DTYPE row.
+
+    Records are copied into arrays allocated on the first add(), so a long session keeps
+    a fixed amount of memory and nothing references frames the camera reuses. The arrays
+    are allocated again only if the frame shape changes.
+    """
+
+    def __init__(self, capacity, max_samples=5):
+        self.capacity = capacity
+        self.max_samples = max_samples
+        self.frame_shape = None
+        self.count = 0  # Records held
+        self.start = 0  # Slot of the oldest record
+
+    def _allocate(self, frame_shape):
+        self.frame_shape = frame_shape
+        self.frames = np.empty((self.capacity,) + frame_shape, dtype=np.uint8)
+        self.samples = np.empty((self.capacity, self.max_samples) + frame_shape, dtype=np.uint8)
+        self.sample_counts = np.zeros(self.capacity, dtype=np.int64)
+        self.records = np.zeros(self.capacity, dtype=RECORD_DTYPE)
+        self.count = 0
+        self.start = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, frame, samples, **fields):
+        """Store a detection, `fields` fill the RECORD_DTYPE row."""
+        if self.frame_shape != frame.shape:
+            self._allocate(frame.shape)
+
+        if self.count == self.capacity:
+            # Overwrite the oldest record
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+        slot = (self.start + self.count) % self.capacity
+        self.count += 1
+
+        np.copyto(self.frames[slot], frame)
+        samples = samples[:self.max_samples]
+        for i, sample in enumerate(samples):
+            np.copyto(self.samples[slot, i], sample)
+        self.sample_counts[slot] = len(samples)
+        self.records[slot] = np.zeros((), dtype=RECORD_DTYPE)
+        for name, value in fields.items():
+            self.records[name][slot] = value
+
+    def pop_oldest(self):
+        """Copy of the oldest record as (row, frame, samples)."""
+        if self.count == 0:
+            return None
+        slot = self.start
+        self.start = (self.start + 1) % self.capacity
+        self.count -= 1
+
+        return self.records[slot].copy(), self.frames[slot].copy(), self.samples[slot, :self.sample_counts[slot]].copy()
+
+
+class WrongMoveArchiver(threading.Thread):
+    """Appends wrong move records to a MisdetectionArchive in the background.
+
+    submit() only queues the record, so the "Wrong Move" button does not wait for the
+    disk. Corrections go through the same queue, after the records they refer to.
+    """
+
+    def __init__(self, archive):
+        super().__init__(daemon=True)
+        self.archive = archive
+        self.tasks = queue.Queue()
+        self.start()
+
+    def submit(self, history_record):
+        self.tasks.put((self.archive.append, history_record))
+
+    def correct(self, fen, move):
+        self.tasks.put((self.archive.set_correction, (fen, move)))
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            method, args = task
+            try:
+                method(*args)
+            except Exception as e:
+                print(f"Could not archive wrong move: {e}")
+
+    def close(self):
+        # Tasks already queued are still written
+        self.tasks.put(None)
+        self.join()
@@ -0,0 +1,310 @@
+import json
+import os
+import time
+import cv2
+import numpy as np
+
+
+class FrameSourceFinished(Exception):
+    """Raised when a finite source (a replay) has no frames left."""
+
+
+class FrameSource:
+    """Where Camera gets its colour frames from.
+
+    read() returns (image, timestamp) with the timestamp in seconds, or (None, None)
+    when no frame is available. `finished` becomes True when a source runs out.
+    Sources with a depth stream set `depth_shape`, and read_depth() then returns the
+    uint16 depth aligned to the colour frame read last (`depth_scale` metres per unit).
+    """
+
+    frame_shape = None
+    depth_shape = None
+    depth_scale = None
+    finished = False
+    lossless = False  # Whether consumers should see every frame instead of the newest
+    corners = None    # Board corners known in advance (replays), otherwise selected by Camera
+
+    def start(self):
+        pass
+
+    def save_corners(self, corners):
+        pass
+
+    def read(self):
+        raise NotImplementedError
+
+    def read_depth(self):
+        return None
+
+    def stop(self):
+        pass
+
+
+class CaptureProfile:
+    """How frames are captured and how much of them is processed.
+
+    width, height and fps are the colour stream settings of a live camera. The board
+    ROI, where hands and stability are checked, is the bounding box of the corners grown
+    by `roi_margin` times the board size on every side. `processing_scale` scales the
+    warped board (1.0 is 20 px/cm); below 0.5 the section tiles get too small for SSIM.
+    """
+
+    def __init__(self, width=1920, height=1080, fps=30, roi_margin=0.35, processing_scale=1.0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.roi_margin = roi_margin
+        self.processing_scale = processing_scale
+
+    @property
+    def pixels_per_cm(self):
+        return int(round(20 * self.processing_scale))
+
+    def board_roi(self, corners, image_shape):
+        """(top, bottom, left, right) of the region around the board corners."""
+        corners = np.asarray(corners, dtype=np.float64)
+        (x_min, y_min), (x_max, y_max) = corners.min(axis=0), corners.max(axis=0)
+        margin_x = (x_max - x_min) * self.roi_margin
+        margin_y = (y_max - y_min) * self.roi_margin
+
+        height, width = image_shape[:2]
+        top, bottom = int(max(0, y_min - margin_y)), int(min(height, y_max + margin_y))
+        left, right = int(max(0, x_min - margin_x)), int(min(width, x_max + margin_x))
+        return top, bottom, left, right
+
+    def to_dict(self):
+        return {'width': self.width, 'height': self.height, 'fps': self.fps,
+                'roi_margin': self.roi_margin, 'processing_scale': self.processing_scale}
+
+
+# Profiles to compare on the benchmark, from the original setup to the cheapest one
+CAPTURE_PROFILES = {
+    'full': CaptureProfile(1920, 1080, 30, processing_scale=1.0),
+    'balanced': CaptureProfile(1280, 720, 30, processing_scale=0.75),
+    'fast': CaptureProfile(960, 540, 30, processing_scale=0.5),
+}
+
+
+def get_capture_profile(profile):
+    """CaptureProfile from a profile, a CAPTURE_PROFILES name or a dict of its arguments."""
+    if profile is None:
+        return CaptureProfile()
+    if isinstance(profile, CaptureProfile):
+        return profile
+    if isinstance(profile, str):
+        return CAPTURE_PROFILES[profile]
+    return CaptureProfile(**profile)
+
+
+class RealSenseSource(FrameSource):
+    def __init__(self, width=1920, height=1080, fps=30, warmup_frames=10, depth=False, depth_size=(848, 480)):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.warmup_frames = warmup_frames
+        self.frame_shape = (height, width, 3)
+
+        # Depth is aligned to the colour frames, so it has their resolution
+        self.depth = depth
+        self.depth_size = depth_size
+        self.depth_shape = (height, width) if depth else None
+        self.depth_image = None
+
+    @classmethod
+    def from_profile(cls, profile, depth=False):
+        return cls(profile.width, profile.height, profile.fps, depth=depth)
+
+    def start(self):
+        import pyrealsense2 as rs
+
+        # Connect camera
+        self.pipe = rs.pipeline()
+        cfg = rs.config()
+        cfg.disable_all_streams()
+        cfg.enable_stream(rs.stream.color, self.width, self.height, rs.format.bgr8, self.fps)
+        if self.depth:
+            cfg.enable_stream(rs.stream.depth, self.depth_size[0], self.depth_size[1], rs.format.z16, self.fps)
+        profile = self.pipe.start(cfg)
+
+        if self.depth:
+            self.depth_scale = profile.get_device().first_depth_sensor().get_depth_scale()
+            self.align = rs.align(rs.stream.color)
+
+        # Lose the first frames, as they are often darker
+        for _ in range(self.warmup_frames):
+            self.pipe.wait_for_frames()
+
+    def read(self):
+        frames = self.pipe.wait_for_frames()
+        if self.depth:
+            frames = self.align.process(frames)
+            depth_frame = frames.get_depth_frame()
+            self.depth_image = np.asanyarray(depth_frame.get_data()) if depth_frame else None
+        color_frame = frames.get_color_frame()
+
+        if not color_frame or (self.depth and self.depth_image is None):
+            return None, None
+
+        return np.asanyarray(color_frame.get_data()), time.monotonic()
+
+    def read_depth(self):
+        return self.depth_image
+
+    def stop(self):
+        self.pipe.stop()
+
+
+# Recording layout: raw uint8 frames appended to frames.bin, float64 timestamps to
+# timestamps.bin, the frame shape in meta.json and the board corners used during the
+# session in corners.json. Sources with depth also append uint16 frames to depth.bin,
+# with the depth shape and scale in meta.json. The frame count follows from the
+# file sizes, so a session cut short is still readable. Replays map the files into
+# memory, so frames are read without copies or decoding.
+
+class FrameRecorder(FrameSource):
+    """Passes frames of another source through while writing them to `path`."""
+
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+        self.frame_count = 0
+
+    @property
+    def frame_shape(self):
+        return self.source.frame_shape
+
+    @property
+    def finished(self):
+        return self.source.finished
+
+    @property
+    def lossless(self):
+        return self.source.lossless
+
+    @property
+    def depth_shape(self):
+        return self.source.depth_shape
+
+    @property
+    def depth_scale(self):
+        return self.source.depth_scale
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.source.start()
+        meta = {'frame_shape': list(self.frame_shape)}
+        if self.depth_shape is not None:
+            meta.update({'depth_shape': list(self.depth_shape), 'depth_scale': self.depth_scale})
+            self.depth_file = open(os.path.join(self.path, 'depth.bin'), 'wb')
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        self.frames_file = open(os.path.join(self.path, 'frames.bin'), 'wb')
+        self.timestamps_file = open(os.path.join(self.path, 'timestamps.bin'), 'wb')
+
+    def read(self):
+        image, timestamp = self.source.read()
+        if image is not None:
+            self.frames_file.write(np.ascontiguousarray(image, dtype=np.uint8).data)
+            if self.depth_shape is not None:
+                self.depth_file.write(np.ascontiguousarray(self.source.read_depth(), dtype=np.uint16).data)
+            self.timestamps_file.write(np.float64(timestamp).tobytes())
+            self.frame_count += 1
+        return image, timestamp
+
+    def read_depth(self):
+        return self.source.read_depth()
+
+    def save_corners(self, corners):
+        with open(os.path.join(self.path, 'corners.json'), 'w') as f:
+            json.dump([[int(x), int(y)] for x, y in corners], f)
+
+    def stop(self):
+        self.source.stop()
+        self.frames_file.close()
+        self.timestamps_file.close()
+        if self.depth_shape is not None:
+            self.depth_file.close()
+
+
+class ReplaySource(FrameSource):
+    """Plays back a FrameRecorder session, at the recorded pace or as fast as possible.
+
+    Unthrottled replays are lossless: the frame grabber waits for the consumer instead
+    of dropping frames and Camera runs the hand model synchronously on every frame it
+    checks, so results do not depend on the speed of the machine. With
+    `size` (width, height) frames and corners are downscaled, to try a lower capture
+    resolution on sessions recorded at full resolution.
+    """
+
+    def __init__(self, path, realtime=True, size=None):
+        self.path = path
+        self.realtime = realtime
+        self.lossless = not realtime
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        recorded_shape = tuple(meta['frame_shape'])
+
+        self.size = size
+        if size is not None and tuple(size) != (recorded_shape[1], recorded_shape[0]):
+            self.frame_shape = (size[1], size[0]) + recorded_shape[2:]
+        else:
+            self.size = None
+            self.frame_shape = recorded_shape
+
+        # Sessions recorded with corners replay without selecting them again
+        corners_path = os.path.join(path, 'corners.json')
+        if os.path.exists(corners_path):
+            with open(corners_path) as f:
+                corners = json.load(f)
+            scale_x, scale_y = self.frame_shape[1] / recorded_shape[1], self.frame_shape[0] / recorded_shape[0]
+            self.corners = [(int(round(x * scale_x)), int(round(y * scale_y))) for x, y in corners]
+
+        # Only whole frames with their timestamp count
+        frames_path, timestamps_path = os.path.join(path, 'frames.bin'), os.path.join(path, 'timestamps.bin')
+        self.frame_count = min(os.path.getsize(frames_path) // int(np.prod(recorded_shape)), os.path.getsize(timestamps_path) // 8)
+
+        # Depth recorded next to the colour frames, resized like them
+        depth_path = os.path.join(path, 'depth.bin')
+        if 'depth_shape' in meta and os.path.exists(depth_path):
+            recorded_depth_shape = tuple(meta['depth_shape'])
+            self.depth_shape = self.frame_shape[:2] if self.size is not None else recorded_depth_shape
+            self.depth_scale = meta['depth_scale']
+            self.frame_count = min(self.frame_count, os.path.getsize(depth_path) // (2 * int(np.prod(recorded_depth_shape))))
+            self.depth_frames = np.memmap(depth_path, dtype=np.uint16, mode='r', shape=(self.frame_count,) + recorded_depth_shape)
+
+        self.frames = np.memmap(frames_path, dtype=np.uint8, mode='r', shape=(self.frame_count,) + recorded_shape)
+        self.timestamps = np.fromfile(timestamps_path, dtype=np.float64, count=self.frame_count)
+        self.position = 0
+
+    def start(self):
+        self.position = 0
+        self.finished = self.frame_count == 0
+        self.start_time = time.monotonic()
+
+    def read(self):
+        if self.position >= self.frame_count:
+            self.finished = True
+            return None, None
+
+        i = self.position
+        self.position += 1
+
+        if self.realtime:
+            delay = self.start_time + (self.timestamps[i] - self.timestamps[0]) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if self.size is not None:
+            return cv2.resize(self.frames[i], self.size, interpolation=cv2.INTER_AREA), self.timestamps[i]
+
+        return self.frames[i], self.timestamps[i]
+
+    def read_depth(self):
+        # Depth of the frame returned by the last read()
+        depth = self.depth_frames[self.position - 1]
+        if self.size is not None:
+            # Nearest neighbour, averaging depth across piece edges invents heights
+            return cv2.resize(depth, self.size, interpolation=cv2.INTER_NEAREST)
+        return depth
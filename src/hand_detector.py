@@ -0,0 +1,139 @@
+import os
+import threading
+import cv2
+import numpy as np
+import mediapipe as mp
+from mediapipe.tasks import python as mp_python
+from mediapipe.tasks.python import vision as mp_vision
+
+
+class HandOcclusionService:
+    """Runs the MediaPipe hand landmarker asynchronously on downscaled frames.
+
+    Frames are submitted with their capture timestamp and results come back on
+    MediaPipe's own thread. Whenever a hand is found the board is considered
+    occluded until `hold_time` seconds after that frame, which callers can query
+    without waiting for the model.
+
+    With `synchronous` the model runs in VIDEO mode instead and submit() returns once
+    the frame is answered. No frame is dropped and nothing depends on wall time, which
+    lossless sources (unthrottled replays) need to give the same results on any machine.
+    """
+
+    def __init__(self, model_path=os.path.join('third_party', 'mediapipe', 'hand_landmarker.task'), scale=0.5, hold_time=1.0, synchronous=False):
+        self.scale = scale
+        self.hold_time = hold_time
+        self.synchronous = synchronous
+
+        self.lock = threading.Lock()
+        self.occluded_until = 0.0  # Frame time until which the board is considered covered
+        self.checked_until = 0.0   # Newest frame time the model has answered for
+        self.last_submitted_ms = -1
+        self.result_timeout = 0.5  # Results older than this are assumed to be in (or dropped)
+
+        base_options = mp_python.BaseOptions(model_asset_path=model_path)
+        if synchronous:
+            options = mp_vision.HandLandmarkerOptions(base_options=base_options,
+                                                      running_mode=mp_vision.RunningMode.VIDEO,
+                                                      num_hands=1)
+        else:
+            options = mp_vision.HandLandmarkerOptions(base_options=base_options,
+                                                      running_mode=mp_vision.RunningMode.LIVE_STREAM,
+                                                      num_hands=1,
+                                                      result_callback=self._on_result)
+        self.hand_detector = mp_vision.HandLandmarker.create_from_options(options)
+
+    def submit(self, color_image, timestamp):
+        # MediaPipe needs strictly increasing timestamps in milliseconds
+        timestamp_ms = int(timestamp * 1000)
+        if timestamp_ms <= self.last_submitted_ms:
+            return
+        self.last_submitted_ms = timestamp_ms
+
+        small = cv2.resize(color_image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        rgb = np.ascontiguousarray(cv2.cvtColor(small, cv2.COLOR_BGR2RGB))
+        mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb)
+
+        if self.synchronous:
+            self._on_result(self.hand_detector.detect_for_video(mp_image, timestamp_ms), mp_image, timestamp_ms)
+            return
+
+        # Returns immediately, frames are dropped by MediaPipe while it is busy
+        self.hand_detector.detect_async(mp_image, timestamp_ms)
+
+    def _on_result(self, detection_result, output_image, timestamp_ms):
+        timestamp = timestamp_ms / 1000
+        with self.lock:
+            self.checked_until = max(self.checked_until, timestamp)
+            if detection_result and detection_result.hand_landmarks:
+                print('Hands Detected!')
+                self.occluded_until = max(self.occluded_until, timestamp + self.hold_time)
+
+    def skip(self, timestamp):
+        # Called for frames the model is not run on because nothing moved. They count as
+        # checked once every frame submitted before them had time to get its result.
+        # Synchronous results are all in already.
+        with self.lock:
+            if self.synchronous or timestamp - self.last_submitted_ms / 1000 > self.result_timeout:
+                self.checked_until = max(self.checked_until, timestamp)
+
+    def is_occluded(self, timestamp):
+        with self.lock:
+            return timestamp < self.occluded_until
+
+    def has_checked(self, timestamp):
+        with self.lock:
+            return self.checked_until >= timestamp
+
+    def close(self):
+        self.hand_detector.close()
+
+
+class MotionGate:
+    """Cheap frame-difference test used to decide when the hand model needs to run.
+
+    Frames are downscaled to grayscale and compared with the previous one. The gate
+    stays open for `cooldown` seconds after the last motion so the hand model gets to
+    look at a hand that has stopped moving.
+    """
+
+    def __init__(self, scale=0.125, pixel_threshold=20, min_changed_fraction=0.005, cooldown=1.0):
+        self.scale = scale
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.cooldown = cooldown
+
+        self.previous = None
+        self.last_motion_time = None
+
+        # Counters to tune the thresholds
+        self.frames = 0
+        self.motion_frames = 0
+        self.open_frames = 0
+
+    def check(self, color_image, timestamp):
+        small = cv2.resize(color_image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        if self.previous is None or self.previous.shape != gray.shape:
+            motion = True
+        else:
+            changed = np.count_nonzero(cv2.absdiff(gray, self.previous) > self.pixel_threshold)
+            motion = changed > self.min_changed_fraction * gray.size
+        self.previous = gray
+
+        if motion:
+            self.last_motion_time = timestamp
+        is_open = self.last_motion_time is not None and timestamp - self.last_motion_time <= self.cooldown
+
+        self.frames += 1
+        self.motion_frames += motion
+        self.open_frames += is_open
+        return is_open
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'motion_rate': self.motion_frames / self.frames if self.frames else 0,
+            'open_rate': self.open_frames / self.frames if self.frames else 0,
+        }
@@ -0,0 +1,81 @@
+import threading
+import tkinter as tk
+import cv2
+import numpy as np
+
+
+class HeatmapView:
+    """Tk window with the latest square difference heatmaps.
+
+    The vision loop only stores a snapshot with publish(). The Tk thread redraws at
+    most every `refresh_ms`, and only when a new snapshot arrived, by turning the 8x8
+    arrays into images through a colour lookup table. Detection never waits on drawing.
+    """
+
+    # Same layout as the old matplotlib figure
+    PANELS = {
+        'main': ("Main Heatmap", 0, 0), 'center': ("Center", 0, 1), 'top': ("Top", 0, 2),
+        'left': ("Left", 1, 0), 'right': ("Right", 1, 1), 'bottom': ("Bottom", 1, 2),
+    }
+
+    def __init__(self, parent, refresh_ms=500, cell_size=32, vmax=100):
+        self.refresh_ms = refresh_ms
+        self.cell_size = cell_size
+        self.vmax = vmax
+        self.margin = 16  # Room for the rank and file labels
+
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.version = 0
+        self.drawn_version = 0
+
+        self.window = tk.Toplevel(parent)
+        self.window.title("Heatmaps")
+
+        board_px = 8 * cell_size
+        self.photos = {}
+        for name, (title, row, col) in self.PANELS.items():
+            frame = tk.Frame(self.window)
+            frame.grid(row=row, column=col, padx=5, pady=5)
+            tk.Label(frame, text=title).pack(side=tk.TOP)
+
+            canvas = tk.Canvas(frame, width=board_px + self.margin, height=board_px + self.margin, highlightthickness=0)
+            canvas.pack(side=tk.TOP)
+            self.photos[name] = tk.PhotoImage(width=board_px, height=board_px)
+            canvas.create_image(self.margin, 0, image=self.photos[name], anchor=tk.NW)
+            for i in range(8):
+                center = i * cell_size + cell_size // 2
+                canvas.create_text(self.margin + center, board_px + self.margin // 2, text='abcdefgh'[i])
+                canvas.create_text(self.margin // 2, center, text=str(8 - i))
+
+        self.window.after(self.refresh_ms, self._refresh)
+
+    def publish(self, main_data, section_data):
+        """Store the newest heatmaps, called from the vision thread."""
+        snapshot = {'main': np.array(main_data, dtype=np.float64)}
+        snapshot.update({section: np.array(data, dtype=np.float64) for section, data in section_data.items()})
+        with self.lock:
+            self.snapshot = snapshot
+            self.version += 1
+
+    def _refresh(self):
+        with self.lock:
+            snapshot, version = self.snapshot, self.version
+
+        try:
+            if snapshot is not None and version != self.drawn_version:
+                for name, data in snapshot.items():
+                    if name in self.photos:
+                        self.photos[name].configure(data=self._to_ppm(data), format='PPM')
+                self.drawn_version = version
+            self.window.after(self.refresh_ms, self._refresh)
+        except tk.TclError:
+            # Window was closed, stop rendering
+            pass
+
+    def _to_ppm(self, data):
+        scaled = np.clip(data / self.vmax * 255, 0, 255).astype(np.uint8)
+        rgb = cv2.cvtColor(cv2.applyColorMap(scaled, cv2.COLORMAP_JET), cv2.COLOR_BGR2RGB)
+        rgb = np.repeat(np.repeat(rgb, self.cell_size, axis=0), self.cell_size, axis=1)
+        height, width = rgb.shape[:2]
+        return b'P6 %d %d 255\n' % (width, height) + rgb.tobytes()
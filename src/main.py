@@ -6,11 +6,23 @@ from robot.src.robot import Robot
 from controller import ChessController, DetectionController, DetectionControllerAudio
 from chessEngine import ChessEngine
 from camera import Camera
+from vision_worker import VisionProcess
+from frame_source import RealSenseSource, FrameRecorder, ReplaySource, CAPTURE_PROFILES
 import queue
 
 # SETUP
 CAMERA = False
 SELECT_CORNERS = True # Select the corners of the chessboard
+SHOW_HEATMAPS = True # Heatmap window, set to False on headless setups
+RECORD_SESSION = None # Folder to record the camera frames to, e.g. 'recordings/session_1'
+REPLAY_SESSION = None # Folder of a recorded session to use instead of the camera
+CAPTURE_PROFILE = 'full' # Resolution and processing scale, see CAPTURE_PROFILES in frame_source.py
+SQUARE_CLASSIFIER = None # Trained square change model (.npz or .onnx) used instead of the SSIM thresholds
+PIECE_STORE = None # Descriptor store from piece_identity.py, e.g. 'models/piece_descriptors'
+USE_DEPTH = False # Check candidates against the squares occupied in the depth stream
+CALIBRATION_FILE = 'calibration.json' # Saved corners, reused at startup while the camera has not moved
+VISION_PROCESS = False # Run the move detection in a separate process, frames shared through shared memory
+TIMING_LOG = None # File the stage timings are appended to every minute as JSON lines, printed when None
 
 MICROPHONE = False # THIS HASNT BEEN TESTED ON THE LAB
 
@@ -56,7 +68,15 @@ def launch_game_mode(mode_selection_window, mode, color=None, engine1="Stockfish
 
         # Create the camera
         max_history = 1 if mode == "human-human" else 2
-        camera = Camera(select_corners=SELECT_CORNERS, large_threshold=LARGE_THRS, small_threshold=SMALL_THRS, max_history=max_history, parent=heatmap_frame)
+        capture_profile = CAPTURE_PROFILES[CAPTURE_PROFILE]
+        if REPLAY_SESSION:
+            frame_source = ReplaySource(REPLAY_SESSION)
+        elif RECORD_SESSION:
+            frame_source = FrameRecorder(RealSenseSource.from_profile(capture_profile, depth=USE_DEPTH), RECORD_SESSION)
+        else:
+            frame_source = RealSenseSource.from_profile(capture_profile, depth=USE_DEPTH)
+        camera_class = VisionProcess if VISION_PROCESS else Camera
+        camera = camera_class(select_corners=SELECT_CORNERS, large_threshold=LARGE_THRS, small_threshold=SMALL_THRS, max_history=max_history, parent=heatmap_frame, show_heatmaps=SHOW_HEATMAPS, frame_source=frame_source, capture_profile=capture_profile, classifier_path=SQUARE_CLASSIFIER, piece_store=PIECE_STORE, use_depth=USE_DEPTH, calibration_path=CALIBRATION_FILE, timing_log=TIMING_LOG)
     else:
         camera = None
 
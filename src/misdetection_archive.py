@@ -0,0 +1,185 @@
+import argparse
+import os
+import cv2
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.gridspec import GridSpec
+from cam_utils import SECTIONS, square_boxes
+from baseline_statistics import BaselineStatistics
+
+# Archive layout: the warped frame of every misdetection followed by its reference
+# samples as raw uint8 images appended to frames.bin, and one fixed size RECORD_DTYPE
+# row per misdetection appended to index.bin. Both files map straight into memory, so
+# tools read any subset of records and tiles without decoding anything. The row is
+# written after the frames, an interrupted append leaves no broken record.
+
+CHANNELS = BaselineStatistics.CHANNELS
+MAX_CANDIDATES = 5
+
+RECORD_DTYPE = np.dtype([
+    ('timestamp', 'f8'),
+    ('offset', 'i8'),            # Byte offset of the images in frames.bin
+    ('height', 'i4'),
+    ('width', 'i4'),
+    ('channels', 'i4'),          # 1 for the grayscale frames Camera compares
+    ('samples', 'i4'),           # Reference samples stored after the frame
+    ('pixels_per_cm', 'i4'),
+    ('extended', '?'),
+    ('fen', 'S92'),              # Position the move was detected on
+    ('candidates', 'S5', (MAX_CANDIDATES,)),  # Detected moves in UCI, best first
+    ('scores', 'f4', (MAX_CANDIDATES,)),
+    ('corrected', 'S5'),         # Move the user entered instead, empty until known
+    ('large_threshold', 'f4'),
+    ('small_threshold', 'f4'),
+    ('move_margin', 'f4'),
+    ('diffs', 'f4', (len(CHANNELS), 64)),          # Mean SSIM difference per channel and square, NaN if not compared
+    ('estimated_max', 'f4', (len(CHANNELS), 64)),  # Baseline thresholds per channel and square
+    ('heatmap', 'f4', (8, 8)),
+    ('detailed_heatmaps', 'f4', (len(SECTIONS), 8, 8)),
+])
+
+
+class MisdetectionArchive:
+    """Append-only store of wrong detections, readable while it is written."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.frames_path = os.path.join(folder, 'frames.bin')
+        self.index_path = os.path.join(folder, 'index.bin')
+        self._index = None
+        self._frames = None
+
+    def append(self, record, frame, samples):
+        """Store `record` (a RECORD_DTYPE row) with its images, returns its number."""
+        os.makedirs(self.folder, exist_ok=True)
+        record = record.copy()
+        images = [frame] + list(samples)
+
+        with open(self.frames_path, 'ab') as f:
+            record['offset'] = f.tell()
+            for image in images:
+                f.write(np.ascontiguousarray(image, dtype=np.uint8).data)
+        record['height'], record['width'] = frame.shape[:2]
+        record['channels'] = frame.shape[2] if frame.ndim == 3 else 1
+        record['samples'] = len(samples)
+
+        with open(self.index_path, 'ab') as f:
+            number = f.tell() // RECORD_DTYPE.itemsize
+            f.write(np.asarray(record, dtype=RECORD_DTYPE).tobytes())
+        return number
+
+    def set_correction(self, fen, move):
+        """Record the move the user played on `fen` for the records of that position without one yet."""
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) == 0:
+            return 0
+        index = np.memmap(self.index_path, dtype=RECORD_DTYPE, mode='r+')
+        matching = np.flatnonzero((index['fen'] == fen.encode()) & (index['corrected'] == b''))
+        index['corrected'][matching] = move.uci().encode()
+        index.flush()
+        del index
+        return len(matching)
+
+    def _map(self):
+        # Mapped again when the files grew since the last read
+        size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        if self._index is None or self._index.nbytes != size:
+            self._index = np.memmap(self.index_path, dtype=RECORD_DTYPE, mode='r') if size else np.zeros(0, RECORD_DTYPE)
+            self._frames = np.memmap(self.frames_path, dtype=np.uint8, mode='r') if size else None
+
+    @property
+    def index(self):
+        self._map()
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def images(self, number):
+        """Frame and reference samples of a record, shape (1 + samples, height, width[, channels]), without copying."""
+        record = self.index[number]
+        shape = (1 + int(record['samples']), int(record['height']), int(record['width']))
+        if record['channels'] > 1:
+            shape += (int(record['channels']),)
+        offset = int(record['offset'])
+        return self._frames[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def tiles(self, number, image=0):
+        """The 64 square tiles of one image of a record (0 is the frame), as views."""
+        record = self.index[number]
+        frame = self.images(number)[image]
+        boxes = square_boxes(frame.shape, pixels_per_cm=int(record['pixels_per_cm']), extended=bool(record['extended']))
+        return [frame[top:bottom, left:right] for top, bottom, left, right in boxes]
+
+    def export(self, number, folder):
+        """Write a record as images and the combined heatmap figure, for looking at it."""
+        record = self.index[number]
+        os.makedirs(folder, exist_ok=True)
+        images = self.images(number)
+
+        # PNG, the frames stay lossless
+        cv2.imwrite(os.path.join(folder, "current_frame.png"), images[0])
+        for i, prev_frame in enumerate(images[1:]):
+            cv2.imwrite(os.path.join(folder, f"prev_turn_sample_{i}.png"), prev_frame)
+
+        detailed = {section: record['detailed_heatmaps'][i] for i, section in enumerate(SECTIONS)}
+        save_combined_heatmap(os.path.join(folder, "combined_heatmap.png"), record['heatmap'], detailed)
+
+
+def save_combined_heatmap(filename, main_heatmap_data, detailed_heatmap_data):
+    # Object-oriented matplotlib API, unlike pyplot it is safe outside the main thread
+    fig = Figure(figsize=(15, 10))
+    gs = GridSpec(2, 4, figure=fig, width_ratios=[1, 1, 1, 0.05])
+
+    # Create main heatmap subplot
+    ax_main = fig.add_subplot(gs[0, 0])
+    image = ax_main.imshow(main_heatmap_data, interpolation='nearest', vmin=0, vmax=50, cmap='jet')
+    ax_main.set_title("Main Heatmap")
+    ax_main.set_xticks(range(8))
+    ax_main.set_yticks(range(8))
+
+    # Create detailed heatmaps based on positions used in _init_heatmaps
+    detailed_heatmap_positions = {
+        'center': (0, 1), 'top': (0, 2),
+        'left': (1, 0), 'right': (1, 1), 'bottom': (1, 2)
+    }
+
+    for section, pos in detailed_heatmap_positions.items():
+        ax = fig.add_subplot(gs[pos])
+        ax.imshow(detailed_heatmap_data[section], interpolation='nearest', vmin=0, vmax=50, cmap='jet')
+        ax.set_title(section.capitalize())
+        ax.set_xticks(range(8))
+        ax.set_yticks(range(8))
+
+        ax.set_xticklabels(['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'])
+        ax.set_yticklabels(['8', '7', '6', '5', '4', '3', '2', '1'])
+
+    # Add colorbar
+    cb_ax = fig.add_subplot(gs[:, -1])
+    fig.colorbar(image, cax=cb_ax)
+
+    # Save the figure
+    fig.tight_layout()
+    fig.savefig(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or export the records of a misdetection archive")
+    parser.add_argument('archive', nargs='?', default=os.path.join('wrong_moves', 'archive'))
+    parser.add_argument('--export', type=int, nargs='*', help="Record numbers to export, all when empty")
+    parser.add_argument('--output', default='wrong_moves_export')
+    args = parser.parse_args()
+
+    archive = MisdetectionArchive(args.archive)
+    index = archive.index
+    for number, record in enumerate(index):
+        candidates = ' '.join(move.decode() for move in record['candidates'] if move)
+        corrected = record['corrected'].decode() or '?'
+        print(f"{number:5d}  {record['fen'].decode():<90}  detected {candidates:<30} corrected {corrected}")
+
+    if args.export is not None:
+        for number in args.export or range(len(index)):
+            archive.export(number, os.path.join(args.output, f"record_{number}"))
+
+
+if __name__ == "__main__":
+    main()
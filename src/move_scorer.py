@@ -0,0 +1,98 @@
+import numpy as np
+from cam_utils import SECTIONS
+
+
+def square_evidence(changed_squares):
+    """Per-square change mask and score for the output of Camera.ssim_small.
+
+    A square scores its center and left sections plus the right section of its right
+    neighbour when that one changed too (pieces lean towards the camera's left).
+    """
+    mask = np.zeros(64, dtype=bool)
+    sections = np.zeros((len(SECTIONS), 64))
+    for idx, _, section_diffs in changed_squares:
+        if not mask[idx]:
+            mask[idx] = True
+            sections[:, idx] = [section_diffs[section] for section in SECTIONS]
+
+    center, left, right = (sections[SECTIONS.index(section)] for section in ('center', 'left', 'right'))
+    right_neighbour = np.zeros(64)
+    has_right = np.arange(63) % 8 != 7
+    right_neighbour[:-1] = np.where(mask[1:] & has_right, right[1:], 0)
+
+    return mask, np.where(mask, center + left + right_neighbour, 0)
+
+
+def rank_moves(move_index, changed_squares):
+    """Score every legal move of the position at once.
+
+    A move is a candidate when its from and to squares both changed, and it scores the
+    evidence of all the squares it changes. Returns (move, score, margin) tuples, best
+    first, where the margin is the lead over the next move.
+    """
+    mask, evidence = square_evidence(changed_squares)
+    return rank_moves_by_evidence(move_index, mask, evidence)
+
+
+def rank_moves_by_evidence(move_index, mask, evidence):
+    """rank_moves for an arbitrary per-square change mask and evidence, e.g. from a classifier."""
+    candidates = mask[move_index.from_idx] & mask[move_index.to_idx].any(axis=1)
+    if not candidates.any():
+        return []
+
+    scores = move_index.signatures[candidates] @ evidence
+    moves = [move_index.move_list[i] for i in np.flatnonzero(candidates)]
+
+    order = np.argsort(-scores, kind='stable')
+    ranked_scores = scores[order]
+    margins = ranked_scores - np.append(ranked_scores[1:], 0)
+    return [(moves[i], float(score), float(margin)) for i, score, margin in zip(order, ranked_scores, margins)]
+
+
+def with_margins(ranked_moves):
+    """Recompute the margins of (move, score, margin) tuples after some were dropped."""
+    scores = [score for _, score, _ in ranked_moves] + [0]
+    return [(move, score, score - scores[i + 1]) for i, (move, score, _) in enumerate(ranked_moves)]
+
+
+def select_changed_squares(square_diffs, estimated_max, large_threshold):
+    """(idx, diff) pairs above both the baseline maximum of their square and large_threshold, largest first."""
+    square_diffs = sorted(square_diffs, key=lambda x: x[1], reverse=True)
+    return [(idx, avg_diff) for idx, avg_diff in square_diffs if avg_diff > estimated_max[idx] and avg_diff > large_threshold]
+
+
+def select_detailed_squares(squares, section_diffs_of, center_max, section_medians):
+    """Changed squares confirmed by their sections, as (idx, diff, section diffs) for rank_moves.
+
+    `section_diffs_of(idx)` gives the section diffs of a square. A square counts when its
+    center changed; when only its right half did, the change is attributed to its right
+    neighbour, as pieces lean into it.
+    """
+    detailed_square_diffs = []
+    added_indices = set()  # To keep track of added square indices
+
+    for idx, avg_diff in squares:
+        avg_diffs = section_diffs_of(idx)
+
+        #########################################################################################
+        # THIS SHOULD BE TESTED MORE, PROBABLY ADDING SOME ML THAT LEARNS IT WOULD BE BETTER
+        # (a learned alternative is square_classifier.py, enabled with classifier_path)
+        #########################################################################################
+
+        if avg_diffs['center'] > center_max[idx]:
+            detailed_square_diffs.append((idx, avg_diff, avg_diffs))
+            added_indices.add(idx)
+        elif avg_diffs['right'] > section_medians['right'][idx] and not avg_diffs['left'] > section_medians['left'][idx]:
+            # The right adjacent square, unless on the right edge of the board
+            right_idx = idx + 1 if (idx + 1) % 8 != 0 else None
+            if right_idx is not None and right_idx not in added_indices:
+                detailed_square_diffs.append((right_idx, avg_diff, avg_diffs))
+
+    return detailed_square_diffs
+
+
+def pick_move(ranked_moves, move_margin, max_candidates=5):
+    """The best move when it is alone or leads by more than move_margin, else the top candidates."""
+    if len(ranked_moves) == 1 or ranked_moves[0][2] > move_margin:
+        return ranked_moves[0][0]
+    return [move for move, _, _ in ranked_moves[:max_candidates]]
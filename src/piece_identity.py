@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import time
+import cv2
+import chess
+import numpy as np
+
+# Store layout: SIFT descriptors of every piece image as raw float32 rows in
+# descriptors.bin, the piece of every row as int16 in labels.bin, and the piece names
+# in meta.json. Readers map the descriptors into memory instead of unpickling keypoints.
+
+PIECE_NAMES = ['White_Pawn', 'White_Knight', 'White_Bishop', 'White_Rook', 'White_Queen', 'White_King',
+               'Black_Pawn', 'Black_Knight', 'Black_Bishop', 'Black_Rook', 'Black_Queen', 'Black_King']
+
+
+def piece_from_name(name):
+    color, piece = name.split('_')
+    return chess.Piece(chess.PIECE_NAMES.index(piece.lower()), color == 'White')
+
+
+def build_descriptor_store(images_dir, store_dir):
+    """Compute SIFT descriptors of images/<Piece>/cropped/*.jpg and write the store."""
+    sift = cv2.SIFT_create()
+    os.makedirs(store_dir, exist_ok=True)
+
+    pieces = [name for name in PIECE_NAMES if os.path.isdir(os.path.join(images_dir, name, 'cropped'))]
+    counts = {}
+    with open(os.path.join(store_dir, 'descriptors.bin'), 'wb') as descriptors_file, \
+            open(os.path.join(store_dir, 'labels.bin'), 'wb') as labels_file:
+        for label, name in enumerate(pieces):
+            folder_path = os.path.join(images_dir, name, 'cropped')
+            counts[name] = 0
+            for filename in sorted(os.listdir(folder_path)):
+                if not filename.endswith(".jpg"):
+                    continue
+                image = cv2.imread(os.path.join(folder_path, filename), cv2.IMREAD_GRAYSCALE)
+                _, descriptors = sift.detectAndCompute(image, None)
+                if descriptors is None:
+                    continue
+                descriptors_file.write(np.ascontiguousarray(descriptors, dtype=np.float32).data)
+                labels_file.write(np.full(len(descriptors), label, dtype=np.int16).data)
+                counts[name] += len(descriptors)
+            print(f"Processed {name}: {counts[name]} descriptors")
+
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'pieces': pieces, 'descriptor_size': sift.descriptorSize(), 'counts': counts}, f)
+
+
+class PieceIdentifier:
+    """Names the piece in image crops by voting over their nearest stored descriptors.
+
+    The descriptors of a store from build_descriptor_store are indexed once in a FLANN
+    KD-tree forest. identify() runs SIFT on every crop, matches all their descriptors in
+    a single knnMatch call and counts the ratio-test matches per piece and crop.
+    """
+
+    def __init__(self, store_dir, ratio=0.75, min_votes=3, trees=4, checks=32):
+        self.ratio = ratio
+        self.min_votes = min_votes
+
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.pieces = [piece_from_name(name) for name in meta['pieces']]
+
+        labels_path = os.path.join(store_dir, 'labels.bin')
+        count = os.path.getsize(labels_path) // 2
+        self.labels = np.memmap(labels_path, dtype=np.int16, mode='r', shape=(count,))
+        self.descriptors = np.memmap(os.path.join(store_dir, 'descriptors.bin'), dtype=np.float32, mode='r',
+                                     shape=(count, meta['descriptor_size']))
+
+        self.sift = cv2.SIFT_create()
+        self.matcher = cv2.FlannBasedMatcher(dict(algorithm=1, trees=trees), dict(checks=checks))  # 1 = KD-tree
+        self.matcher.add([np.asarray(self.descriptors)])
+        self.matcher.train()
+
+    def identify(self, crops):
+        """Most voted chess.Piece for every grayscale crop, or None without enough votes."""
+        query, owners = [], []
+        for i, crop in enumerate(crops):
+            _, descriptors = self.sift.detectAndCompute(crop, None)
+            if descriptors is not None and len(descriptors) > 0:
+                query.append(descriptors)
+                owners.append(np.full(len(descriptors), i))
+
+        results = [None] * len(crops)
+        if not query:
+            return results
+
+        query, owners = np.vstack(query), np.concatenate(owners)
+        matches = self.matcher.knnMatch(query, k=2)
+
+        votes = np.zeros((len(crops), len(self.pieces)), dtype=np.int64)
+        for match_pair in matches:
+            if len(match_pair) == 2 and match_pair[0].distance < self.ratio * match_pair[1].distance:
+                votes[owners[match_pair[0].queryIdx], self.labels[match_pair[0].trainIdx]] += 1
+
+        for i, crop_votes in enumerate(votes):
+            if crop_votes.max() >= self.min_votes:
+                results[i] = self.pieces[int(crop_votes.argmax())]
+        return results
+
+
+def benchmark(store_dir, images_dir, repeats=20):
+    """Time identify() on a batch of stored crops and report how many it names right."""
+    identifier = PieceIdentifier(store_dir)
+    names = [name for name in PIECE_NAMES if os.path.isdir(os.path.join(images_dir, name, 'cropped'))]
+    crops, expected = [], []
+    for name in names:
+        folder_path = os.path.join(images_dir, name, 'cropped')
+        filename = sorted(os.listdir(folder_path))[0]
+        crops.append(cv2.imread(os.path.join(folder_path, filename), cv2.IMREAD_GRAYSCALE))
+        expected.append(piece_from_name(name))
+
+    identifier.identify(crops[:2])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        results = identifier.identify(crops[:2])
+    elapsed = (time.perf_counter() - start) / repeats
+
+    results = identifier.identify(crops)
+    correct = sum(result == piece for result, piece in zip(results, expected))
+    print(f"{len(identifier.labels)} descriptors, 2 crops in {elapsed * 1000:.2f} ms, {correct}/{len(crops)} stored crops named right")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or time the piece descriptor store")
+    parser.add_argument('--images', default='images')
+    parser.add_argument('--store', default=os.path.join('models', 'piece_descriptors'))
+    parser.add_argument('--benchmark', action='store_true', help="Time lookups on an existing store")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.store, args.images)
+    else:
+        build_descriptor_store(args.images, args.store)
+
+
+if __name__ == "__main__":
+    main()
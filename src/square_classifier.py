@@ -0,0 +1,210 @@
+import argparse
+import os
+import cv2
+import numpy as np
+from cam_utils import move_squares, chess_square_to_camera_perspective
+
+# Every tile is resized to TILE_SIZE x TILE_SIZE, the extended column included. The input
+# tensor is (64, 3, TILE_SIZE, TILE_SIZE): the current tile, the mean of its reference
+# tiles and their absolute difference, scaled to [0, 1].
+TILE_SIZE = 16
+
+
+def tile_batch(frame, boxes, size=TILE_SIZE):
+    """All squares of a warped grayscale frame as one (64, size, size) float32 array."""
+    batch = np.empty((len(boxes), size, size), dtype=np.float32)
+    for i, (top, bottom, left, right) in enumerate(boxes):
+        batch[i] = cv2.resize(frame[top:bottom, left:right], (size, size), interpolation=cv2.INTER_AREA)
+    return batch
+
+
+class SquareChangeClassifier:
+    """Per-square change probabilities for a frame, in one inference call for all 64 squares.
+
+    The model is either a small MLP stored as .npz (run with NumPy) or any .onnx model
+    taking the (64, 3, TILE_SIZE, TILE_SIZE) batch and returning 64 probabilities (run with
+    ONNX Runtime, which is only needed for that case). Reference tiles are cached until
+    the reference frames change. `threshold` is the probability above which a square
+    counts as changed, chosen on held-out frames by fit() and saved with the weights.
+    """
+
+    def __init__(self, path=None, weights=None):
+        self.session = None
+        if path is not None and path.endswith('.onnx'):
+            import onnxruntime as ort
+            self.session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+        elif path is not None:
+            weights = dict(np.load(path))
+        self.weights = weights
+        self.threshold = float(weights['threshold']) if weights is not None and 'threshold' in weights else 0.5
+        self.validation_scores = None  # Held-out precision and recall of the last fit()
+
+        self.references = None
+        self.reference_tiles = None
+
+    def features(self, frame, references, boxes):
+        if references is not self.references:
+            self.reference_tiles = np.mean([tile_batch(reference, boxes) for reference in references], axis=0)
+            self.references = references
+
+        tiles = tile_batch(frame, boxes)
+        batch = np.stack([tiles, self.reference_tiles, np.abs(tiles - self.reference_tiles)], axis=1)
+        return batch / 255
+
+    def predict_batch(self, batch):
+        """Probabilities for a (N, 3, TILE_SIZE, TILE_SIZE) batch."""
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: batch.astype(np.float32)})[0].reshape(-1)
+
+        return _forward(self.weights, batch.reshape(len(batch), -1))[1]
+
+    def predict(self, frame, references, boxes):
+        """Change probability of every square of `frame` against the reference frames."""
+        return self.predict_batch(self.features(frame, references, boxes))
+
+    @classmethod
+    def fit(cls, batches, labels, hidden=32, epochs=500, learning_rate=1e-3, validation=0.2, seed=0):
+        """Train the NumPy MLP on stacked feature batches and 0/1 change labels.
+
+        Full-batch Adam on the weighted cross-entropy. Changed squares are rare, so both
+        classes weigh the same in total, with weights averaging 1. A `validation` fraction
+        of the frames is held out: the threshold is the one with the best F1 on it, and its
+        precision and recall are kept in validation_scores.
+        """
+        X = np.asarray(batches, dtype=np.float32).reshape(len(batches), 64, -1)
+        y = np.asarray(labels, dtype=np.float32).reshape(len(labels), 64)
+
+        # Whole frames are held out, their squares are not independent. Frames with a
+        # change are rare, so they are split separately to have some on both sides.
+        rng = np.random.default_rng(seed)
+        held_out, train = [], []
+        for frames in (np.flatnonzero(y.any(axis=1)), np.flatnonzero(~y.any(axis=1))):
+            frames = rng.permutation(frames)
+            count = int(round(len(frames) * validation))
+            held_out.extend(frames[:count])
+            train.extend(frames[count:])
+        X_train, y_train = X[train].reshape(-1, X.shape[2]), y[train].reshape(-1)
+
+        positive = min(max(y_train.mean(), 1e-6), 1 - 1e-6)
+        sample_weight = np.where(y_train > 0.5, 0.5 / positive, 0.5 / (1 - positive))
+
+        w = {
+            'W1': (rng.standard_normal((X.shape[2], hidden)) * np.sqrt(2 / X.shape[2])).astype(np.float32),
+            'b1': np.zeros(hidden, dtype=np.float32),
+            'W2': (rng.standard_normal((hidden, 1)) * np.sqrt(1 / hidden)).astype(np.float32),
+            'b2': np.zeros(1, dtype=np.float32),
+        }
+        moments = {name: (np.zeros_like(value), np.zeros_like(value)) for name, value in w.items()}
+        beta1, beta2, eps = 0.9, 0.999, 1e-8
+        for step in range(1, epochs + 1):
+            hidden_out, p = _forward(w, X_train)
+
+            grad_logit = ((p - y_train) * sample_weight / len(y_train))[:, None]
+            grad_hidden = (grad_logit @ w['W2'].T) * (hidden_out > 0)
+            grads = {'W2': hidden_out.T @ grad_logit, 'b2': grad_logit.sum(axis=0),
+                     'W1': X_train.T @ grad_hidden, 'b1': grad_hidden.sum(axis=0)}
+
+            for name, grad in grads.items():
+                m, v = moments[name]
+                m *= beta1
+                m += (1 - beta1) * grad
+                v *= beta2
+                v += (1 - beta2) * grad ** 2
+                w[name] -= learning_rate * (m / (1 - beta1 ** step)) / (np.sqrt(v / (1 - beta2 ** step)) + eps)
+
+        classifier = cls(weights=w)
+        if len(held_out):
+            probabilities = _forward(w, X[held_out].reshape(-1, X.shape[2]))[1]
+            classifier.validation_scores = best_threshold(probabilities, y[held_out].reshape(-1))
+            classifier.threshold = classifier.validation_scores['threshold']
+        w['threshold'] = np.array(classifier.threshold, dtype=np.float32)
+        return classifier
+
+    def save(self, path):
+        np.savez(path, **self.weights)
+
+
+def _forward(w, X):
+    # Hidden activations and probabilities of the MLP for flattened feature rows
+    hidden = np.maximum(X @ w['W1'] + w['b1'], 0)
+    return hidden, 1 / (1 + np.exp(-(hidden @ w['W2'] + w['b2']).reshape(-1)))
+
+
+def best_threshold(probabilities, labels, thresholds=np.linspace(0.05, 0.95, 19)):
+    """Threshold with the best F1 on labelled squares, with its precision and recall.
+
+    When several thresholds tie, as on a cleanly separated validation set, the middle
+    one is taken so the margin is the same on both sides.
+    """
+    changed = labels > 0.5
+    scores = []
+    for threshold in thresholds:
+        predicted = probabilities > threshold
+        true_positives = np.count_nonzero(predicted & changed)
+        precision = true_positives / max(np.count_nonzero(predicted), 1)
+        recall = true_positives / max(np.count_nonzero(changed), 1)
+        f1 = 2 * precision * recall / (precision + recall) if true_positives else 0.0
+        scores.append({'threshold': float(threshold), 'precision': float(precision), 'recall': float(recall), 'f1': float(f1)})
+
+    best_f1 = max(score['f1'] for score in scores)
+    if best_f1 == 0:
+        return {'threshold': 0.5, 'precision': 0.0, 'recall': 0.0, 'f1': 0.0}
+    tied = [score for score in scores if score['f1'] >= best_f1 - 1e-9]
+    return tied[len(tied) // 2]
+
+
+class TrainingCollector:
+    """benchmark.run_session observer that labels the frames recognize_move looked at.
+
+    Frames where the played move was found are labelled with the squares that move
+    changes, frames where nothing was found as unchanged. Moves the SSIM path misses add
+    label noise, so collect with loose thresholds.
+    """
+
+    def __init__(self):
+        self.featurizer = SquareChangeClassifier()
+        self.batches = []
+        self.labels = []
+
+    def __call__(self, camera, board, detected, expected, found):
+        if detected is not None and not found:
+            return  # False positive, the frame may still be mid-move
+
+        labels = np.zeros(64, dtype=np.float32)
+        if found:
+            for square in move_squares(board, expected):
+                labels[chess_square_to_camera_perspective(square)] = 1
+
+        self.batches.append(self.featurizer.features(camera.frame, camera.previous_frames, camera.square_boxes))
+        self.labels.append(labels)
+
+
+def main():
+    from benchmark import find_sessions, load_config, run_session
+
+    parser = argparse.ArgumentParser(description="Train the square change classifier on recorded sessions")
+    parser.add_argument('sessions', help="Session folder, or a folder of session folders")
+    parser.add_argument('--config', default=None, help="JSON with Camera arguments used while collecting")
+    parser.add_argument('--output', default=os.path.join('models', 'square_classifier.npz'))
+    parser.add_argument('--hidden', type=int, default=32)
+    parser.add_argument('--epochs', type=int, default=500)
+    parser.add_argument('--validation', type=float, default=0.2, help="Fraction of the frames held out to pick the threshold")
+    args = parser.parse_args()
+
+    collector = TrainingCollector()
+    for session_path in find_sessions(args.sessions):
+        run_session(session_path, load_config(args.config), observer=collector)
+
+    classifier = SquareChangeClassifier.fit(collector.batches, collector.labels, hidden=args.hidden, epochs=args.epochs,
+                                            validation=args.validation)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    classifier.save(args.output)
+    print(f"Trained on {len(collector.labels)} frames, saved to {args.output}")
+    scores = classifier.validation_scores
+    if scores is not None:
+        print(f"Held-out frames: threshold {scores['threshold']:.2f}, precision {scores['precision']:.3f}, recall {scores['recall']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
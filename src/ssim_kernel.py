@@ -0,0 +1,139 @@
+import time
+import cv2
+import numpy as np
+
+# Bound on the difference to skimage's structural_similarity per tile, for uint8 images
+# with data_range 255. Up to 5e-8 was seen on noise, stripes and smooth boards (see
+# benchmark()), the camera works with (1 - score) * 100 so this is 1e-4 points there.
+SKIMAGE_TOLERANCE = 1e-6
+
+
+class SSIMKernel:
+    """SSIM of two images pooled over many boxes, in float32 with reused buffers.
+
+    Same definition as ssim_map/pool_ssim_map in cam_utils (uniform window, sample
+    covariance), so the pooled score of a box equals structural_similarity on that tile
+    within SKIMAGE_TOLERANCE. Images are shifted by half the data range before the
+    moments are computed, which keeps the float32 variances accurate. Buffers only
+    grow: a smaller image uses contiguous views of their start, so crops of varying
+    size are compared without allocating.
+    """
+
+    def __init__(self, win_size=7, data_range=255, K1=0.01, K2=0.03):
+        self.win_size = win_size
+        self.ksize = (win_size, win_size)
+        self.pad = (win_size - 1) // 2
+        self.offset = data_range / 2
+        self.cov_norm = win_size ** 2 / (win_size ** 2 - 1)
+        self.C1 = (K1 * data_range) ** 2
+        self.C2 = (K2 * data_range) ** 2
+        self.shape = None
+        self.buffers = np.empty((9, 0), dtype=np.float32)
+        self.integral_buffer = np.empty(0, dtype=np.float64)
+
+    def _allocate(self, shape):
+        self.shape = shape
+        size = shape[0] * shape[1]
+        integral_size = (shape[0] + 1) * (shape[1] + 1)
+        if size > self.buffers.shape[1]:
+            self.buffers = np.empty((9, size), dtype=np.float32)
+        if integral_size > len(self.integral_buffer):
+            self.integral_buffer = np.empty(integral_size, dtype=np.float64)
+
+        views = [buffer[:size].reshape(shape) for buffer in self.buffers]
+        self.x, self.y, self.ux, self.uy, self.uxx, self.uyy, self.uxy, self.tmp, self.S = views
+        self.integral = self.integral_buffer[:integral_size].reshape(shape[0] + 1, shape[1] + 1)
+
+    def map(self, im1, im2):
+        """Local SSIM map of two grayscale images, valid until the next call."""
+        if im1.shape != self.shape:
+            self._allocate(im1.shape)
+        x, y, tmp = self.x, self.y, self.tmp
+        ux, uy, uxx, uyy, uxy = self.ux, self.uy, self.uxx, self.uyy, self.uxy
+
+        np.subtract(im1, self.offset, out=x, dtype=np.float32)
+        np.subtract(im2, self.offset, out=y, dtype=np.float32)
+
+        cv2.blur(x, self.ksize, dst=ux)
+        cv2.blur(y, self.ksize, dst=uy)
+        cv2.blur(np.multiply(x, x, out=tmp), self.ksize, dst=uxx)
+        cv2.blur(np.multiply(y, y, out=tmp), self.ksize, dst=uyy)
+        cv2.blur(np.multiply(x, y, out=tmp), self.ksize, dst=uxy)
+
+        # Variances and covariance, the shift does not change them
+        uxx -= np.multiply(ux, ux, out=tmp)
+        uyy -= np.multiply(uy, uy, out=tmp)
+        uxy -= np.multiply(ux, uy, out=tmp)
+
+        # Contrast-structure term: (2 vxy + C2) / (vx + vy + C2)
+        S = self.S
+        np.multiply(uxy, 2 * self.cov_norm, out=S)
+        S += self.C2
+        np.add(uxx, uyy, out=tmp)
+        tmp *= self.cov_norm
+        tmp += self.C2
+        S /= tmp
+
+        # Luminance term on the unshifted means: (2 ux uy + C1) / (ux^2 + uy^2 + C1)
+        ux += self.offset
+        uy += self.offset
+        np.multiply(ux, uy, out=tmp)
+        tmp *= 2
+        tmp += self.C1
+        S *= tmp
+        np.multiply(ux, ux, out=tmp)
+        tmp += self.C1
+        tmp += np.multiply(uy, uy, out=uxy)
+        S /= tmp
+        return S
+
+    def pool(self, S, boxes):
+        """Mean of the map inside each box without the filter border, like pool_ssim_map."""
+        integral = cv2.integral(S, sum=self.integral, sdepth=cv2.CV_64F)
+        pad = self.pad
+        top, bottom = boxes[..., 0] + pad, boxes[..., 1] - pad
+        left, right = boxes[..., 2] + pad, boxes[..., 3] - pad
+        sums = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+        return sums / ((bottom - top) * (right - left))
+
+    def scores(self, im1, im2, boxes):
+        """SSIM score of every box, `boxes` can have any leading shape."""
+        return self.pool(self.map(im1, im2), boxes)
+
+
+def benchmark(repeats=20, seed=0):
+    """Compare the kernel with skimage per tile and with the float64 map of cam_utils."""
+    from skimage.metrics import structural_similarity as ssim
+    from cam_utils import ssim_map, pool_ssim_map, square_boxes, channel_boxes, divide_into_squares
+
+    # Board sized images with a smooth pattern, noise and a few moved pieces
+    rng = np.random.default_rng(seed)
+    im1 = cv2.GaussianBlur(rng.integers(0, 256, (560, 620), dtype=np.uint8), (9, 9), 3)
+    im2 = cv2.add(im1, rng.integers(0, 6, im1.shape, dtype=np.uint8))
+    im2[100:160, 200:250] = 255 - im2[100:160, 200:250]
+
+    boxes = channel_boxes(square_boxes(im1.shape))
+    kernel = SSIMKernel()
+
+    def measure(func):
+        func()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            result = func()
+        return (time.perf_counter() - start) / repeats, result
+
+    def skimage_scores():
+        return np.array([ssim(a, b) for a, b in zip(divide_into_squares(im1), divide_into_squares(im2))])
+
+    skimage_time, reference = measure(skimage_scores)
+    float64_time, float64_scores = measure(lambda: pool_ssim_map(ssim_map(im1, im2), boxes))
+    kernel_time, kernel_scores = measure(lambda: kernel.scores(im1, im2, boxes).copy())
+
+    print(f"skimage per tile: {skimage_time * 1000:8.2f} ms (squares only)")
+    print(f"float64 map:      {float64_time * 1000:8.2f} ms, max error {np.abs(float64_scores[0] - reference).max():.2e}")
+    print(f"SSIMKernel:       {kernel_time * 1000:8.2f} ms, max error {np.abs(kernel_scores[0] - reference).max():.2e}"
+          f" (sections {np.abs(kernel_scores - float64_scores).max():.2e} from float64)")
+
+
+if __name__ == "__main__":
+    benchmark()
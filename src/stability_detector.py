@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+
+
+class StabilityDetector:
+    """Decides when the board has settled, one frame at a time.
+
+    Each frame is reduced a few pyramid levels and compared with the first frame of the
+    current stable run, not only with the previous frame, so a slow movement that
+    changes little between consecutive frames still adds up and restarts the run. A
+    frame is stable when only a small fraction of its pixels changed noticeably since
+    that first frame, and the board is settled after `stable_frames` consecutive stable
+    frames. Nothing here sleeps, so the decision is taken at camera rate.
+    """
+
+    def __init__(self, stable_frames=5, pyramid_levels=3, pixel_threshold=12, max_changed_fraction=0.002, smoothing=0.5):
+        self.stable_frames = stable_frames
+        self.pyramid_levels = pyramid_levels
+        self.pixel_threshold = pixel_threshold
+        self.max_changed_fraction = max_changed_fraction
+        self.smoothing = smoothing
+
+        self.anchor = None          # First frame of the current stable run
+        self.stable_count = 0
+        self.difference = 0.0       # Running (smoothed) changed fraction, for diagnostics
+        self.settled_time = None    # Time of the frame that completed the stable run
+
+    def reset(self):
+        # The next frame starts a new run
+        self.anchor = None
+        self.stable_count = 0
+        self.settled_time = None
+
+    def update(self, gray, timestamp):
+        """Feed the next grayscale frame, returns whether the board is settled."""
+        small = gray
+        for _ in range(self.pyramid_levels):
+            small = cv2.pyrDown(small)
+
+        if self.anchor is None or self.anchor.shape != small.shape:
+            self.reset()
+            self.anchor = small
+            return False
+
+        changed = np.count_nonzero(cv2.absdiff(small, self.anchor) > self.pixel_threshold) / small.size
+        self.difference = self.smoothing * self.difference + (1 - self.smoothing) * changed
+
+        if changed > self.max_changed_fraction:
+            # Still moving, the run starts again from this frame
+            self.reset()
+            self.anchor = small
+            return False
+
+        self.stable_count += 1
+        if self.stable_count >= self.stable_frames and self.settled_time is None:
+            self.settled_time = timestamp
+
+        return self.settled_time is not None
@@ -0,0 +1,109 @@
+import json
+import time
+import numpy as np
+
+STAGES = ['capture_wait', 'warp', 'hands', 'stability', 'square_ssim', 'section_ssim', 'classify', 'move_scoring', 'heatmap', 'recognize']
+
+# Histogram bucket edges in seconds, log spaced from 10 us to 10 s
+BUCKET_EDGES = np.geomspace(1e-5, 10, 37)
+
+
+class _Measurement:
+    __slots__ = ('timer', 'stage', 'start')
+
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer:
+    """Durations of the vision loop stages, kept as fixed histograms.
+
+    Each stage has a count, total, maximum and a histogram over BUCKET_EDGES, so memory
+    stays constant however long the session runs. Percentiles are read from the buckets
+    (the upper edge of the bucket they fall in, at most the maximum). Timing uses
+    perf_counter, which is monotonic. 'recognize' is a whole recognize_move call, the
+    other stages are its parts, and capture stages count every frame read, settled or not.
+    """
+
+    def __init__(self, stages=STAGES, dump_interval=60.0, dump_path=None):
+        self.stages = list(stages)
+        self.dump_interval = dump_interval
+        self.dump_path = dump_path
+        self.reset()
+
+    def reset(self):
+        shape = len(self.stages)
+        self.counts = np.zeros(shape, dtype=np.int64)
+        self.totals = np.zeros(shape)
+        self.maxima = np.zeros(shape)
+        self.histograms = np.zeros((shape, len(BUCKET_EDGES) + 1), dtype=np.int64)
+        self.last_dump = time.monotonic()
+
+    def measure(self, stage):
+        """Context manager adding the duration of its block to `stage`."""
+        return _Measurement(self, stage)
+
+    def add(self, stage, seconds):
+        s = self.stages.index(stage)
+        self.counts[s] += 1
+        self.totals[s] += seconds
+        if seconds > self.maxima[s]:
+            self.maxima[s] = seconds
+        self.histograms[s, np.searchsorted(BUCKET_EDGES, seconds)] += 1
+
+    def percentile(self, stage, q):
+        s = self.stages.index(stage)
+        if self.counts[s] == 0:
+            return 0.0
+        bucket = np.searchsorted(np.cumsum(self.histograms[s]), q / 100 * self.counts[s])
+        return float(min(BUCKET_EDGES[min(bucket, len(BUCKET_EDGES) - 1)], self.maxima[s]))
+
+    def snapshot(self):
+        """Statistics of every stage measured so far, times in milliseconds."""
+        snapshot = {}
+        for s, stage in enumerate(self.stages):
+            count = int(self.counts[s])
+            if count == 0:
+                continue
+            snapshot[stage] = {
+                'count': count,
+                'total_ms': float(self.totals[s]) * 1000,
+                'mean_ms': float(self.totals[s] / count) * 1000,
+                'p50_ms': self.percentile(stage, 50) * 1000,
+                'p90_ms': self.percentile(stage, 90) * 1000,
+                'p99_ms': self.percentile(stage, 99) * 1000,
+                'max_ms': float(self.maxima[s]) * 1000,
+                'histogram': self.histograms[s].tolist(),
+            }
+        return snapshot
+
+    def format(self, snapshot=None):
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        lines = [f"{'stage':<14}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for stage, stats in snapshot.items():
+            lines.append(f"{stage:<14}{stats['count']:>8}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}"
+                         f"{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+        return "\n".join(lines)
+
+    def dump(self):
+        """Append the snapshot as a JSON line to dump_path, or print it without one."""
+        self.last_dump = time.monotonic()
+        snapshot = self.snapshot()
+        if self.dump_path is None:
+            print(self.format(snapshot))
+            return
+        with open(self.dump_path, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'stages': snapshot}) + "\n")
+
+    def maybe_dump(self):
+        if self.dump_interval and time.monotonic() - self.last_dump > self.dump_interval:
+            self.dump()
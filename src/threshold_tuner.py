@@ -0,0 +1,271 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import chess
+import numpy as np
+from benchmark import BenchmarkResult, create_camera, detection_found, detection_key, find_sessions, load_config, read_game
+from baseline_statistics import BaselineStatistics
+from cam_utils import SECTIONS, LegalMoveIndex
+from frame_source import FrameSourceFinished
+from move_scorer import rank_moves, select_changed_squares, select_detailed_squares, pick_move
+
+# Tuning replays the threshold rules of Camera on cached SSIM features instead of the
+# frames. A session is replayed through Camera once, and for every settled frame the
+# differences of the relevant squares and their sections against each reference are
+# saved (NaN for the squares Camera did not compare), with the baseline statistics at
+# the start of every ply. Any combination of the parameters below is then evaluated in
+# a fraction of a second per session, so a process pool goes through hundreds of them
+# in minutes.
+#
+# The cached frames are those the collection config processed: a ply ends `settle_frames`
+# frames after that config found the move. Settings that would only find it later count
+# it as missed, so collect with thresholds at least as permissive as the ones searched.
+# Parameters that change which frames are processed (stability) or that need the frames
+# (classifier, depth, piece pruning) are compared with benchmark.py instead.
+
+# Camera attributes (benchmark config keys) the tuner can replay, with the default search space
+DEFAULT_SPACE = {
+    'large_threshold': [5, 10, 15, 20, 25, 30],
+    'detailed_threshold': [4, 6, 8, 10],
+    'move_margin': [20, 35, 50, 75, 100],
+    'baseline_stats.z_score': [2.33, 2.58, 3.09, 3.72],  # Percentiles 0.99 to 0.9999
+}
+DEFAULTS = {'large_threshold': 20, 'detailed_threshold': 6, 'move_margin': 50, 'baseline_stats.z_score': 3.09}
+
+
+def collect_session(session_path, config, cache_dir, settle_frames=5):
+    """Replay a session through Camera and save the SSIM features of every settled frame."""
+    game = read_game(session_path)
+    board = game.board()
+    expected_moves = list(game.mainline_moves())
+
+    camera = create_camera(session_path, config)
+    if camera.square_classifier is not None or not camera.batched_ssim:
+        camera.close()
+        raise ValueError("Features are only collected on the batched SSIM path")
+
+    frame_diffs, frame_ply, fens, moves, baselines = [], [], [], [], []
+    stats = camera.baseline_stats
+    try:
+        for ply, expected in enumerate(expected_moves):
+            fens.append(board.fen())
+            moves.append(expected.uci())
+            baselines.append(np.stack([stats.count, stats.mean, stats.var, stats.median_offset]))
+
+            remaining = None  # Frames still recorded after the move was found
+            while remaining != 0:
+                changed = camera.compare_squares(board)
+                frame_diffs.append(camera.frame_diffs.astype(np.float32))
+                frame_ply.append(ply)
+
+                if remaining is not None:
+                    remaining -= 1
+                elif changed:
+                    ranked = rank_moves(camera.get_move_index(board), changed)
+                    if ranked and detection_found(pick_move(ranked, camera.move_margin), expected):
+                        remaining = settle_frames
+
+            board.push(expected)
+            camera.update_after_move(board)
+    except FrameSourceFinished:
+        pass
+    finally:
+        camera.close()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(os.path.join(cache_dir, 'frame_diffs.npy'), np.array(frame_diffs, dtype=np.float32).reshape(-1, *camera.frame_diffs.shape))
+    np.save(os.path.join(cache_dir, 'frame_ply.npy'), np.array(frame_ply, dtype=np.int64))
+    np.save(os.path.join(cache_dir, 'baselines.npy'), np.array(baselines).reshape(-1, 4, len(stats.CHANNELS), 64))
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump({'session': os.path.abspath(session_path), 'config': config, 'settle_frames': settle_frames,
+                   'total_moves': len(expected_moves), 'fens': fens, 'moves': moves}, f)
+
+
+def load_features(cache_dir):
+    """Cached features of a session, the arrays mapped from disk."""
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        features = json.load(f)
+    for name in ['frame_diffs', 'frame_ply', 'baselines']:
+        features[name] = np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r')
+    return features
+
+
+def cache_folder(cache_root, session_path):
+    # Sessions of different folders often share a name (game_1, ...), so the folder is
+    # keyed on a hash of the absolute path, the name is kept to find it by hand
+    session_path = os.path.abspath(session_path)
+    digest = hashlib.sha1(session_path.encode()).hexdigest()[:12]
+    return os.path.join(cache_root, f"{os.path.basename(session_path)}_{digest}")
+
+
+def cached_features(sessions, config, cache_root, settle_frames=5, refresh=False):
+    """Cache folders of the sessions, collecting the ones missing or made with another config."""
+    cache_dirs = []
+    for session_path in sessions:
+        cache_dir = cache_folder(cache_root, session_path)
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        if not refresh and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if (meta['session'] == os.path.abspath(session_path) and meta['config'] == config
+                    and meta['settle_frames'] == settle_frames):
+                cache_dirs.append(cache_dir)
+                continue
+
+        print(f"[collect] {session_path}")
+        collect_session(session_path, config, cache_dir, settle_frames)
+        cache_dirs.append(cache_dir)
+    return cache_dirs
+
+
+def evaluate_session(features, params, result):
+    """Replay the threshold rules of Camera.compare_squares on the cached frames of one session."""
+    large_threshold = params['large_threshold']
+    detailed_threshold = int(params['detailed_threshold'])
+    move_margin = params['move_margin']
+    stats = BaselineStatistics()
+    stats.z_score = params['baseline_stats.z_score']
+
+    frame_diffs = features['frame_diffs']
+    ply_starts = np.searchsorted(features['frame_ply'], np.arange(len(features['fens']) + 1))
+    result.moves += features['total_moves']
+    found_count = 0
+
+    for ply, (fen, uci) in enumerate(zip(features['fens'], features['moves'])):
+        board = chess.Board(fen)
+        expected = chess.Move.from_uci(uci)
+        move_index = LegalMoveIndex(board)
+        stats.count, stats.mean, stats.var, stats.median_offset = (np.array(values) for values in features['baselines'][ply])
+        wrong_detections = set()  # Counted once per ply, as in benchmark.run_session
+
+        for diffs in frame_diffs[ply_starts[ply]:ply_starts[ply + 1]]:
+            means = diffs.mean(axis=0)
+            changed = select_changed_squares([(idx, means[0, idx]) for idx in move_index.relevant_squares],
+                                             stats.estimated_max('overall'), large_threshold)
+            if not changed:
+                # Idle frame, the baseline follows it as in Camera.update_baseline_statistics
+                stats.update_idle(diffs)
+                result.idle_calls += 1
+                continue
+
+            section_medians = {section: stats.median(section) for section in SECTIONS}
+            detailed = select_detailed_squares(changed[:detailed_threshold],
+                                               lambda idx: {section: means[c + 1, idx] for c, section in enumerate(SECTIONS)},
+                                               stats.estimated_max('center'), section_medians)
+            ranked = rank_moves(move_index, detailed) if detailed else []
+            if not ranked:
+                result.idle_calls += 1
+                continue
+
+            detected = pick_move(ranked, move_margin)
+            if detection_found(detected, expected):
+                if isinstance(detected, list):
+                    result.ambiguous += 1
+                else:
+                    result.exact += 1
+                found_count += 1
+                break
+            key = detection_key(detected)
+            if key not in wrong_detections:
+                wrong_detections.add(key)
+                result.false_positives += 1
+
+    result.missed += features['total_moves'] - found_count
+
+
+_features = None
+
+
+def _init_worker(cache_dirs):
+    # Every worker maps the caches once, the pages are shared between processes
+    global _features
+    _features = [load_features(cache_dir) for cache_dir in cache_dirs]
+
+
+def _evaluate(params):
+    result = BenchmarkResult(json.dumps(params))
+    for features in _features:
+        evaluate_session(features, params, result)
+    return params, result.summary()
+
+
+def grid_settings(space):
+    keys = list(space)
+    for values in itertools.product(*(space[key] for key in keys)):
+        yield {**DEFAULTS, **dict(zip(keys, values))}
+
+
+def random_settings(space, count, seed=0):
+    """`count` settings drawn uniformly between the smallest and largest value of every key."""
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        setting = dict(DEFAULTS)
+        for key, values in space.items():
+            low, high = min(values), max(values)
+            if all(isinstance(value, int) for value in values):
+                setting[key] = int(rng.integers(low, high + 1))
+            else:
+                setting[key] = round(float(rng.uniform(low, high)), 3)
+        yield setting
+
+
+def rank_key(entry):
+    _, summary = entry
+    return (-summary['accuracy'], summary['false_positive_rate'], summary['ambiguity_rate'])
+
+
+def print_ranking(ranking, top=10):
+    keys = list(DEFAULTS)
+    print("-"*20)
+    print("".join(f"{key.split('.')[-1]:>20}" for key in keys) + f"{'accuracy':>10}{'ambiguity':>10}{'false pos':>10}{'missed':>8}")
+    for params, summary in ranking[:top]:
+        print("".join(f"{params[key]:>20}" for key in keys)
+              + f"{summary['accuracy']:>10.3f}{summary['ambiguity_rate']:>10.3f}{summary['false_positive_rate']:>10.3f}{summary['missed']:>8}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the detection thresholds on recorded sessions")
+    parser.add_argument('sessions', help="Session folder, or a folder of session folders")
+    parser.add_argument('--config', default=None, help="JSON with the Camera configuration features are collected with")
+    parser.add_argument('--cache', default='tuning_cache', help="Folder of the cached features")
+    parser.add_argument('--refresh', action='store_true', help="Collect the features again")
+    parser.add_argument('--settle-frames', type=int, default=5, help="Frames cached after the collection config found a move")
+    parser.add_argument('--space', default=None, help="JSON of parameter value lists, DEFAULT_SPACE otherwise")
+    parser.add_argument('--random', type=int, default=None, help="Draw this many random settings instead of the grid")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', default=None, help="Write every setting and its summary to this JSON file")
+    parser.add_argument('--best-config', default=None, help="Write the best setting as a benchmark.py config")
+    args = parser.parse_args()
+
+    sessions = find_sessions(args.sessions)
+    cache_dirs = cached_features(sessions, load_config(args.config), args.cache, args.settle_frames, args.refresh)
+
+    space = load_config(args.space) or DEFAULT_SPACE
+    settings = list(random_settings(space, args.random, args.seed) if args.random else grid_settings(space))
+
+    start = time.perf_counter()
+    workers = args.workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cache_dirs,)) as pool:
+        ranking = list(pool.map(_evaluate, settings, chunksize=max(1, len(settings) // (workers * 4))))
+    ranking.sort(key=rank_key)
+    print(f"{len(settings)} settings on {len(sessions)} sessions in {time.perf_counter() - start:.1f} s")
+
+    print_ranking(ranking, args.top)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump([{'params': params, 'summary': summary} for params, summary in ranking], f, indent=2)
+    if args.best_config is not None:
+        with open(args.best_config, 'w') as f:
+            json.dump({**load_config(args.config), **ranking[0][0]}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from frame_source import FrameSource, FrameSourceFinished, RealSenseSource, get_capture_profile
+
+# The vision pipeline (hands, stability, SSIM, scoring) can run in its own process so it
+# does not share the GIL with the Tk GUI and the transcriber. The main process keeps the
+# camera: a writer thread copies every frame into shared memory slots, the worker reads
+# them without any pickling. Commands go to the worker and move candidates come back
+# over multiprocessing queues, which only carry boards, moves and small heatmaps.
+
+
+class SharedFrameRing:
+    """Fixed frame slots in shared memory, written by one process and read by another.
+
+    Every slot records the number of the frame it holds. The writer sets it to -1 while
+    copying, so a reader that raced with the writer sees a different number after its
+    copy and tries again (a sequence lock), and neither side ever blocks the other.
+    """
+
+    def __init__(self, frame_shape, depth_shape=None, capacity=4, name=None):
+        self.frame_shape = tuple(frame_shape)
+        self.depth_shape = tuple(depth_shape) if depth_shape is not None else None
+        self.capacity = capacity
+
+        frame_size = int(np.prod(self.frame_shape))
+        depth_size = int(np.prod(self.depth_shape)) * 2 if self.depth_shape is not None else 0
+        size = 16 + 16 * capacity + capacity * (frame_size + depth_size)
+
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        buf = self.shm.buf
+
+        # Header: number of the newest frame and a closed flag, then per-slot numbers and times
+        self.header = np.ndarray((2,), dtype=np.int64, buffer=buf, offset=0)
+        self.sequence = np.ndarray((capacity,), dtype=np.int64, buffer=buf, offset=16)
+        self.timestamps = np.ndarray((capacity,), dtype=np.float64, buffer=buf, offset=16 + 8 * capacity)
+        offset = 16 + 16 * capacity
+        self.frames = np.ndarray((capacity,) + self.frame_shape, dtype=np.uint8, buffer=buf, offset=offset)
+        self.depth_frames = None
+        if self.depth_shape is not None:
+            offset += capacity * frame_size
+            self.depth_frames = np.ndarray((capacity,) + self.depth_shape, dtype=np.uint16, buffer=buf, offset=offset)
+
+        if self.owner:
+            self.header[:] = 0
+            self.sequence[:] = 0
+
+    def spec(self):
+        """What another process needs to attach to this ring."""
+        return {'name': self.shm.name, 'frame_shape': self.frame_shape, 'depth_shape': self.depth_shape, 'capacity': self.capacity}
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(spec['frame_shape'], spec['depth_shape'], spec['capacity'], name=spec['name'])
+
+    @property
+    def closed(self):
+        return bool(self.header[1])
+
+    def close(self):
+        self.header[1] = 1
+
+    def write(self, image, timestamp, depth=None):
+        n = int(self.header[0]) + 1
+        slot = n % self.capacity
+
+        self.sequence[slot] = -1
+        np.copyto(self.frames[slot], image)
+        if depth is not None:
+            np.copyto(self.depth_frames[slot], depth)
+        self.timestamps[slot] = timestamp
+        self.sequence[slot] = n
+        self.header[0] = n
+
+    def read_latest(self, after=0):
+        """(number, frame, timestamp, depth) of the newest frame numbered above `after`, or None."""
+        for _ in range(self.capacity):
+            n = int(self.header[0])
+            if n <= after:
+                return None
+
+            slot = n % self.capacity
+            if self.sequence[slot] != n:
+                continue
+            frame = self.frames[slot].copy()
+            depth = self.depth_frames[slot].copy() if self.depth_frames is not None else None
+            timestamp = float(self.timestamps[slot])
+            if self.sequence[slot] == n:
+                return n, frame, timestamp, depth
+        return None
+
+    def release(self):
+        # The views must go before the shared memory can be closed
+        self.header = self.sequence = self.timestamps = self.frames = self.depth_frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedFrameWriter(threading.Thread):
+    """Copies the frames of a FrameSource into a SharedFrameRing."""
+
+    def __init__(self, source, ring):
+        super().__init__(daemon=True)
+        self.source = source
+        self.ring = ring
+        self.running = True
+
+    def run(self):
+        try:
+            while self.running:
+                image, timestamp = self.source.read()
+                if image is None:
+                    if self.source.finished:
+                        break
+                    continue
+                depth = self.source.read_depth() if self.ring.depth_shape is not None else None
+                self.ring.write(image, timestamp, depth)
+        except Exception:
+            # A read interrupted by stop() is expected, anything else is reported
+            if self.running:
+                raise
+        finally:
+            self.ring.close()
+
+    def stop(self):
+        """Stop the thread and the source, returns once the ring is no longer written."""
+        self.running = False
+        if self.ident is None:
+            self.source.stop()
+            return
+        self.join(timeout=1)
+        # Stopping the source wakes a read still waiting for a frame
+        self.source.stop()
+        self.join()
+
+
+class SharedFrameSource(FrameSource):
+    """FrameSource of the worker process, reading the newest frame of a SharedFrameRing."""
+
+    def __init__(self, ring_spec, corners=None, depth_scale=None, results=None, poll_interval=0.002):
+        self.ring = SharedFrameRing.attach(ring_spec)
+        self.frame_shape = self.ring.frame_shape
+        self.depth_shape = self.ring.depth_shape
+        self.depth_scale = depth_scale
+        self.corners = corners
+        self.results = results
+        self.poll_interval = poll_interval
+        self.last_number = 0
+        self.depth_image = None
+
+    def read(self):
+        while True:
+            latest = self.ring.read_latest(self.last_number)
+            if latest is not None:
+                self.last_number, image, timestamp, self.depth_image = latest
+                return image, timestamp
+            if self.ring.closed:
+                self.finished = True
+                return None, None
+            time.sleep(self.poll_interval)
+
+    def read_depth(self):
+        return self.depth_image
+
+    def save_corners(self, corners):
+        # Recorders live in the main process
+        if self.results is not None:
+            self.results.put(('corners', None, list(corners)))
+
+    def stop(self):
+        self.ring.release()
+
+
+def vision_worker(ring_spec, camera_kwargs, commands, results, heatmap_interval=0.5):
+    """Worker process main loop: runs Camera on the shared frames and answers commands."""
+    from camera import Camera
+
+    # Importing the pipeline takes seconds. The main process starts the camera (or the
+    # replay) only after this, and sends what the source knows once started.
+    results.put(('attached', None, None))
+    _, source_info = commands.get()
+
+    source = SharedFrameSource(ring_spec, results=results, **source_info)
+    try:
+        camera = Camera(frame_source=source, show_heatmaps=False, **camera_kwargs)
+    except FrameSourceFinished:
+        results.put(('finished', None, None))
+        return
+    results.put(('ready', None, None))
+
+    request = None  # (request id, board) of the recognition in progress
+    last_heatmaps = 0
+    try:
+        while True:
+            # Block while idle, only peek while recognizing
+            try:
+                command, *args = commands.get(timeout=0.05) if request is None else commands.get_nowait()
+            except queue.Empty:
+                command = None
+
+            if command == 'stop':
+                break
+            elif command == 'recognize':
+                request = args
+            elif command == 'cancel':
+                request = None
+            elif command == 'update_after_move':
+                request = None
+                camera.update_after_move(args[0])
+            elif command == 'sample_board':
+                request = None
+                camera.sample_board()
+            elif command == 'request_resample':
+                request = None
+                camera.request_resample()
+            elif command == 'archive_wrong_move':
+                camera.archive_wrong_move(args[0])
+            elif command == 'record_correction':
+                camera.record_correction(*args)
+            elif command == 'print_stats':
+                camera.print_stats()
+            elif command == 'stage_timing':
+                results.put(('stage_timing', None, camera.stage_timer.snapshot()))
+            elif command == 'set':
+                setattr(camera, args[0], args[1])
+
+            if request is None or command is not None:
+                continue
+
+            request_id, board = request
+            move = camera.recognize_move(board)
+
+            if time.monotonic() - last_heatmaps > heatmap_interval:
+                results.put(('heatmaps', None, (camera.heatmap_data, camera.detailed_heatmap_data)))
+                last_heatmaps = time.monotonic()
+
+            if move is not None:
+                results.put(('move', request_id, move))
+                request = None
+    except FrameSourceFinished:
+        results.put(('finished', None, None))
+    finally:
+        camera.close()
+
+
+class VisionProcess:
+    """Camera running in a worker process, with the methods the controllers call.
+
+    recognize_move() never blocks: it asks the worker to look for a move on the given
+    board and returns the answer on a later call, once the worker found one. Everything
+    else is forwarded and runs in the worker in order.
+    """
+
+    def __init__(self, select_corners, parent=None, show_heatmaps=True, frame_source=None, capture_profile=None,
+                 use_depth=False, **camera_kwargs):
+        capture_profile = get_capture_profile(capture_profile)
+        self.frame_source = frame_source if frame_source is not None else RealSenseSource.from_profile(capture_profile, depth=use_depth)
+
+        self.ring = SharedFrameRing(self.frame_source.frame_shape, self.frame_source.depth_shape)
+        self.writer = SharedFrameWriter(self.frame_source, self.ring)
+
+        # Spawned, so the worker does not inherit the Tk and camera threads
+        context = mp.get_context('spawn')
+        self.commands = context.Queue()
+        self.results = context.Queue()
+        camera_kwargs.update(select_corners=select_corners, capture_profile=capture_profile, use_depth=use_depth)
+        self.process = context.Process(target=vision_worker, args=(self.ring.spec(), camera_kwargs, self.commands, self.results), daemon=True)
+        self.process.start()
+
+        # Frames only flow once the worker can take them: a replay started earlier would
+        # be seconds into the game before the worker samples the starting position
+        self._wait_for('attached')
+        self.frame_source.start()
+        self.writer.start()
+        self.commands.put(('source_info', {'corners': self.frame_source.corners, 'depth_scale': self.frame_source.depth_scale}))
+
+        self.large_threshold = camera_kwargs.get('large_threshold', 20)
+        self.small_threshold = camera_kwargs.get('small_threshold', 10)
+        self.is_active = True
+        self.finished = False
+
+        self.request_id = 0
+        self.pending = None  # (request id, fen) of the recognition asked for
+        self.found = None    # Move or candidates answering the pending request
+
+        self.stage_timing = {}  # Last StageTimer snapshot of the worker, see request_stage_timing
+
+        self.heatmap_view = None
+        if show_heatmaps:
+            from heatmap_view import HeatmapView
+            self.heatmap_view = HeatmapView(parent)
+
+        self._wait_until_ready()
+
+    def _handle(self, kind, request_id, payload):
+        if kind == 'move' and self.pending is not None and request_id == self.pending[0]:
+            self.found = payload
+        elif kind == 'heatmaps' and self.heatmap_view is not None:
+            self.heatmap_view.publish(*payload)
+        elif kind == 'stage_timing':
+            self.stage_timing = payload
+        elif kind == 'corners':
+            self.frame_source.save_corners(payload)
+        elif kind == 'finished':
+            self.finished = True
+        return kind
+
+    def _poll(self):
+        while True:
+            try:
+                self._handle(*self.results.get_nowait())
+            except queue.Empty:
+                return
+
+    def _wait_for(self, *kinds):
+        while True:
+            try:
+                if self._handle(*self.results.get(timeout=1)) in kinds:
+                    return
+            except queue.Empty:
+                if not self.process.is_alive():
+                    self.writer.stop()
+                    self.ring.release()
+                    raise RuntimeError("The vision worker exited while starting")
+
+    def _wait_until_ready(self):
+        # Calibration happens in the worker, corner selection included
+        self._wait_for('ready', 'finished')
+        if self.finished:
+            self.close()
+            raise FrameSourceFinished()
+
+    def recognize_move(self, board):
+        self._poll()
+        fen = board.fen()
+
+        if self.found is not None and self.pending[1] == fen:
+            move, self.found, self.pending = self.found, None, None
+            return move
+
+        if self.pending is None or self.pending[1] != fen:
+            self.request_id += 1
+            self.pending = (self.request_id, fen)
+            self.found = None
+            self.commands.put(('recognize', self.request_id, board.copy()))
+        return None
+
+    def _forget_request(self):
+        self.pending = None
+        self.found = None
+
+    def update_after_move(self, board):
+        self._forget_request()
+        self.commands.put(('update_after_move', board.copy()))
+
+    def sample_board(self):
+        self._forget_request()
+        self.commands.put(('sample_board',))
+
+    def request_resample(self):
+        self._forget_request()
+        self.commands.put(('request_resample',))
+
+    def request_update_after_move(self, board):
+        # Commands already run on the worker's thread, in order
+        self.update_after_move(board)
+
+    def archive_wrong_move(self, num_moves_to_pop):
+        self.commands.put(('archive_wrong_move', num_moves_to_pop))
+
+    def record_correction(self, board, move):
+        self.commands.put(('record_correction', board.copy(), move))
+
+    def print_stats(self):
+        self.commands.put(('print_stats',))
+
+    def request_stage_timing(self):
+        # The snapshot arrives in stage_timing on a later poll
+        self.commands.put(('stage_timing',))
+
+    def pause_camera(self):
+        self.is_active = False
+        self._forget_request()
+        self.commands.put(('cancel',))
+
+    def resume_camera(self):
+        self.is_active = True
+
+    def get_large_threshold(self):
+        return self.large_threshold
+
+    def set_large_threshold(self, value):
+        self.large_threshold = value
+        self.commands.put(('set', 'large_threshold', value))
+
+    def get_small_threshold(self):
+        return self.small_threshold
+
+    def set_small_threshold(self, value):
+        self.small_threshold = value
+        self.commands.put(('set', 'small_threshold', value))
+
+    def close(self):
+        self.commands.put(('stop',))
+        self.process.join(timeout=5)
+        # Waits for the writer, so it cannot write to the released shared memory
+        self.writer.stop()
+        self.ring.release()